@@ -1,32 +1,36 @@
 import asyncio
 import copy
-import hashlib
-import os
+import math
 import random
 import traceback
-from io import BytesIO
-from itertools import chain
-from pathlib import Path
-from typing import List, Union, Tuple
+from typing import List, Union, Tuple, Optional, Match
 
 from aiocqhttp.exceptions import ActionFailed
 from meme_generator.download import check_resources
 from meme_generator.exception import MemeGeneratorException
 from meme_generator.meme import Meme
-from meme_generator.utils import render_meme_list, MemeProperties
-from pypinyin import Style, pinyin
 
 from hoshino import HoshinoBot, Service, priv
-from hoshino.aiorequests import run_sync_func
 from hoshino.typing import CQEvent, MessageSegment, Message
-from .config import meme_command_start, memes_normal_error
-from .data_source import ImageSource, UserInfo
+from .cache import disk_cache
+from .config import (
+    meme_command_start,
+    memes_fetch_concurrency,
+    memes_fetch_deadline,
+    memes_normal_error,
+    memes_rate_limit_reply,
+    memes_render_busy_reply,
+    memes_render_timeout_reply,
+)
+from .data_source import ImageSource, UserInfo, fetch_images
 from .depends import split_msg_v11
-from .exception import NetworkError
+from .exception import DownloadRejectedError, NetworkError, RenderBusyError, RenderTimeoutError
 from .manager import ActionResult, MemeMode, meme_manager
-from .utils import meme_info, bytesio2b64
-
-memes_cache_dir = Path(os.path.join(os.path.dirname(__file__), "memes_cache_dir"))
+from .permission import Principal
+from .ratelimit import rate_limiter
+from .render import clear_render_cache, render, render_cache, render_engine, render_flight, render_queue
+from .transport import transport
+from .utils import meme_info, help_list, clear_previews, get_msg
 
 sv_help = """
 [表情包制作] 发送全部功能帮助
@@ -50,53 +54,19 @@ async def bangzhu_text(bot: HoshinoBot, ev: CQEvent):
     await bot.send(ev, sv_help, at_sender=True)
 
 
-def get_user_id(ev: CQEvent, permit: Union[int, None] = None):
+def get_user_id(ev: CQEvent, permit: Union[int, None] = None) -> Principal:
     if permit is None or permit < 21:
-        cid = f"{ev.self_id}_{ev.group_id}_{ev.user_id}"
-    else:
-        cid = f"{ev.self_id}_{ev.group_id}"
-    return cid
+        return Principal(str(ev.self_id), str(ev.group_id), str(ev.user_id))
+    return Principal(str(ev.self_id), str(ev.group_id))
 
 
 @sv.on_fullmatch(("表情包制作", "头像表情包", "文字表情包"))
 async def help_cmd(bot: HoshinoBot, ev: CQEvent):
-    memes = sorted(
-        meme_manager.memes,
-        key=lambda meme: "".join(
-            chain.from_iterable(pinyin(meme.keywords[0], style=Style.TONE3))
-        ),
-    )
-    meme_list: List[Tuple[Meme, MemeProperties]] = []
-    for single_meme in memes:
-        disabled = not meme_manager.check(get_user_id(ev), single_meme.key)
-        meme_list.append((single_meme, MemeProperties(disabled=disabled)))
-    # cache rendered meme list
-    meme_list_hashable = [
-        (
-            {
-                "key": meme.key,
-                "keywords": meme.keywords,
-                "shortcuts": [
-                    shortcut.humanized or shortcut.key for shortcut in meme.shortcuts
-                ],
-                "tags": sorted(meme.tags),
-            },
-            prop,
-        )
-        for meme, prop in meme_list
-    ]
-    meme_list_hash = hashlib.md5(str(meme_list_hashable).encode("utf8")).hexdigest()
-    meme_list_cache_file = memes_cache_dir / f"{meme_list_hash}.jpg"
-    if not meme_list_cache_file.exists():
-        img: BytesIO = await run_sync_func(render_meme_list, meme_list)
-        with open(meme_list_cache_file, "wb") as f:
-            f.write(img.getvalue())
-    else:
-        img = BytesIO(meme_list_cache_file.read_bytes())
+    img = await help_list(get_user_id(ev))
 
     msg = "触发方式：“关键词 + 图片/文字”\n发送 “表情详情 + 关键词” 查看表情参数和预览\n目前支持的表情列表："
 
-    await bot.finish(ev, msg + MessageSegment.image(bytesio2b64(img)))
+    await bot.finish(ev, msg + MessageSegment.image(img))
 
 
 @sv.on_prefix(("表情帮助", "表情示例", "表情详情"))
@@ -117,7 +87,7 @@ async def info_cmd(bot: HoshinoBot, ev: CQEvent):
 @sv.on_prefix("禁用表情")
 async def block_cmd(bot: HoshinoBot, ev: CQEvent):
     meme_names = ev.message.extract_plain_text().strip().split()
-    user_id: str = get_user_id(ev)
+    user_id: Principal = get_user_id(ev)
     if not meme_names:
         await bot.finish(ev, "参数出错，请重新输入")
     results = meme_manager.block(user_id, meme_names)
@@ -136,7 +106,7 @@ async def block_cmd(bot: HoshinoBot, ev: CQEvent):
 @sv.on_prefix("启用表情")
 async def unblock_cmd(bot: HoshinoBot, ev: CQEvent):
     meme_names = ev.message.extract_plain_text().strip().split()
-    user_id: str = get_user_id(ev)
+    user_id: Principal = get_user_id(ev)
     if not meme_names:
         await bot.finish(ev, "参数出错，请重新输入")
     results = meme_manager.unblock(user_id, meme_names)
@@ -192,6 +162,27 @@ async def unblock_cmd_gl(bot: HoshinoBot, ev: CQEvent):
     await bot.finish(ev, "\n".join(messages))
 
 
+@sv.on_fullmatch("表情缓存状态")
+async def cache_stats_cmd(bot: HoshinoBot, ev: CQEvent):
+    if not priv.check_priv(ev, priv.SUPERUSER):
+        await bot.finish(ev, "此命令仅超级用户可用~")
+    stats = disk_cache.stats()
+    queue = render_queue.stats()
+    messages = [
+        f"磁盘缓存：{stats['entries']} 个文件，{stats['bytes'] / 10 ** 6:.1f}MB",
+        f"  命中 {stats['hits']} 次，未命中 {stats['misses']} 次，淘汰 {stats['evictions']} 次",
+        f"制作结果缓存：{len(render_cache)} 个，{render_cache.nbytes / 10 ** 6:.1f}MB",
+        f"  命中 {render_cache.hits} 次，未命中 {render_cache.misses} 次，合并相同请求 {render_flight.shared} 次",
+        f"制作队列：{queue['running']} 个制作中，{queue['waiting']} 个排队，已拒绝 {queue['rejected']} 个",
+        f"  近期平均排队 {queue['avg_wait']:.2f}s，最长 {queue['max_wait']:.2f}s",
+    ]
+    if timeouts := render_engine.timeout_counts.most_common(5):
+        messages.append(
+            "制作超时：" + "，".join(f"{key} {count} 次" for key, count in timeouts)
+        )
+    await bot.finish(ev, "\n".join(messages))
+
+
 async def process(
     bot: HoshinoBot,
     ev: CQEvent,
@@ -203,14 +194,17 @@ async def process(
 ):
     if args is None:
         args = {}
-    images: List[bytes] = []
-
     try:
-        for image_source in image_sources:
-            images.append(await image_source.get_image())
+        images = await fetch_images(
+            image_sources, memes_fetch_concurrency, memes_fetch_deadline
+        )
     except NotImplementedError:
         await bot.send(ev, "当前平台可能不支持获取图片")
         return
+    except DownloadRejectedError as e:
+        sv.logger.warning(f"图片下载被中止: {e}")
+        await bot.send(ev, e.reason)
+        return
     except NetworkError:
         sv.logger.warning(traceback.format_exc())
         await bot.send(ev, "图片下载出错，请稍后再试")
@@ -226,7 +220,16 @@ async def process(
     args["user_infos"] = args_user_infos
 
     try:
-        result = await run_sync_func(meme, images=images, texts=texts, args=args)
+        result = await render(meme.key, images, texts, args, ev.group_id)
+    except RenderBusyError as e:
+        sv.logger.warning(f"表情 {meme.key} 未能制作: {e}")
+        if memes_render_busy_reply:
+            await bot.send(ev, memes_render_busy_reply)
+        return
+    except RenderTimeoutError:
+        if memes_render_timeout_reply:
+            await bot.send(ev, memes_render_timeout_reply)
+        return
     except MemeGeneratorException as e:
         if memes_normal_error:
             await bot.send(ev, e.message)
@@ -234,14 +237,14 @@ async def process(
         return
 
     try:
-        await bot.send(ev, MessageSegment.image(bytesio2b64(result)))
+        await bot.send(ev, MessageSegment.image(await transport.encode(result)))
     except ActionFailed:
         await bot.send(ev, "发送失败……消息可能被风控")
 
 
 async def find_meme(
     trigger: str, raw_trigger: str, bot: HoshinoBot, ev: CQEvent
-) -> Union[Union[Tuple[Meme, bool, bool], Tuple[None, None, bool]]]:
+) -> Union[Tuple[Meme, Optional[Match[str]], bool], Tuple[None, None, bool]]:
     if trigger == "随机表情":
         meme = random.choice(meme_manager.memes)
         uid = get_user_id(ev)
@@ -250,11 +253,44 @@ async def find_meme(
             return None, None, True
 
         await bot.send(ev, f"随机到了【{meme.keywords[0]}】")
-        return meme, False, True
-    meme, regex = meme_manager.find(trigger)
+        return meme, None, True
+    meme, match = meme_manager.find(trigger)
     if meme is None:
-        meme, regex = meme_manager.find(raw_trigger)
-    return meme, regex, False
+        meme, match = meme_manager.find(raw_trigger)
+    return meme, match, False
+
+
+def strip_reply_at(msg: Message, source_qq: Optional[str]) -> Message:
+    """去除回复消息开头的隐式 at，`source_qq` 为 None 时把开头的 at 都视为隐式 at"""
+    msg = copy.copy(msg)
+    # 隐式at和显示at之间还有一个文本空格
+    while len(msg) > 1 and (
+        msg[1].type == "at"
+        or msg[1].type == "text"
+        and msg[1].data["text"].strip() == ""
+    ):
+        if msg[1].type == "at" and (source_qq is None or msg[1].data["qq"] == source_qq):
+            msg.pop(1)
+        elif msg[1].type == "text" and msg[1].data["text"].strip() == "":
+            msg.pop(1)
+            break
+        else:
+            break
+    return msg
+
+
+def select_trigger(msg: Message) -> Optional[MessageSegment]:
+    for each_msg in msg:
+        if not each_msg.type == "text":
+            continue
+        if not each_msg.data["text"].strip().startswith(meme_command_start):
+            continue
+        return each_msg
+    for each_msg in msg:
+        if not each_msg.type == "text":
+            continue
+        return each_msg
+    return None
 
 
 @sv.on_message("group")
@@ -263,40 +299,12 @@ async def handle(bot: HoshinoBot, ev: CQEvent):
     if not msg:
         sv.logger.debug("Empty msg, skip")
         return
-    if msg[0].type == "reply":
-        # 当回复目标是自己时，去除隐式at自己
-        msg_id = msg[0].data["id"]
-        source_msg = await bot.get_msg(message_id=int(msg_id))
-        source_qq = str(source_msg["sender"]["user_id"])
-        # 隐式at和显示at之间还有一个文本空格
-        while len(msg) > 1 and (
-            msg[1].type == "at"
-            or msg[1].type == "text"
-            and msg[1].data["text"].strip() == ""
-        ):
-            if msg[1].type == "at" and msg[1].data["qq"] == source_qq:
-                msg.pop(1)
-            elif msg[1].type == "text" and msg[1].data["text"].strip() == "":
-                msg.pop(1)
-                break
-            else:
-                break
-    for each_msg in msg:
-        if not each_msg.type == "text":
-            continue
-        if not each_msg.data["text"].strip().startswith(meme_command_start):
-            continue
-        trigger = each_msg
-        break
-    else:
-        for each_msg in msg:
-            if not each_msg.type == "text":
-                continue
-            trigger = each_msg
-            break
-        else:
-            sv.logger.debug("Empty trigger, skip")
-            return
+    is_reply = msg[0].type == "reply"
+    # 先假定开头的 at 都是回复带来的隐式 at，确定触发词；匹配到表情后再查询原消息
+    trigger = select_trigger(strip_reply_at(msg, None) if is_reply else msg)
+    if trigger is None:
+        sv.logger.debug("Empty trigger, skip")
+        return
 
     uid = get_user_id(ev)
     try:
@@ -308,7 +316,7 @@ async def handle(bot: HoshinoBot, ev: CQEvent):
     if not trigger_text.startswith(meme_command_start):
         # sv.logger.debug("Empty prefix, skip")
         return
-    meme, is_regex, is_random = await find_meme(
+    meme, match, is_random = await find_meme(
         trigger_text.replace(meme_command_start, "").strip(),
         raw_trigger_text.replace(meme_command_start, "").strip(),
         bot,
@@ -320,8 +328,23 @@ async def handle(bot: HoshinoBot, ev: CQEvent):
     if not meme_manager.check(uid, meme.key):
         sv.logger.debug("Blocked meme, skip")
         return
+    if not priv.check_priv(ev, priv.SUPERUSER) and (wait := rate_limiter.check(uid, meme)):
+        sv.logger.info(f"{uid} 制作表情 {meme.key} 超出频率限制")
+        if memes_rate_limit_reply and rate_limiter.notify(uid, wait):
+            await bot.send(ev, memes_rate_limit_reply.format(wait=math.ceil(wait)))
+        return
+
+    if is_reply:
+        # 当回复目标是自己时，去除隐式at自己
+        source_msg = await get_msg(bot, ev, int(msg[0].data["id"]))
+        msg = strip_reply_at(msg, str(source_msg["sender"]["user_id"]))
+        exact_trigger = select_trigger(msg)
+        if exact_trigger is None or exact_trigger.data["text"] != trigger.data["text"]:
+            sv.logger.debug("Trigger changed after resolving reply, skip")
+            return
+        trigger = exact_trigger
 
-    split_msg = await split_msg_v11(bot, ev, msg, meme, trigger, is_regex, is_random)
+    split_msg = await split_msg_v11(bot, ev, msg, meme, trigger, match, is_random)
     if not split_msg:
         if memes_normal_error:
             await bot.send(ev, f"表情 {meme.keywords[0]} 不存在！")
@@ -344,4 +367,6 @@ async def update_res(bot: HoshinoBot, ev: CQEvent):
     except Exception as e:
         await bot.send(ev, f"更新资源出错：\n{e}")
         return
+    await clear_previews()
+    await clear_render_cache()
     await bot.send(ev, f"更新资源完成")
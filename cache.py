@@ -0,0 +1,299 @@
+import asyncio
+import os
+import re
+import time
+import uuid
+from collections import OrderedDict
+from pathlib import Path
+from typing import Awaitable, Callable, Dict, Generic, Hashable, List, Optional, Tuple, TypeVar
+
+import hoshino
+from hoshino.aiorequests import run_sync_func
+from .config import memes_cache_max_entries, memes_cache_max_size, memes_cache_policy
+
+memes_cache_dir = Path(os.path.join(os.path.dirname(__file__), "memes_cache_dir"))
+
+K = TypeVar("K", bound=Hashable)
+V = TypeVar("V")
+
+
+class LRUCache(Generic[K, V]):
+    """按最近使用淘汰的内存缓存，可同时限制条目数和总字节数（为 0 时不限制）
+
+    条目被淘汰、覆盖或清空时调用 `on_evict`。
+    """
+
+    def __init__(
+        self,
+        maxsize: int = 128,
+        maxbytes: int = 0,
+        sizeof: Callable[[V], int] = len,
+        on_evict: Optional[Callable[[K, V], None]] = None,
+    ):
+        self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.__sizeof = sizeof
+        self.__on_evict = on_evict
+        self.__data: "OrderedDict[K, V]" = OrderedDict()
+        self.__sizes: dict = {}
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self.__data)
+
+    def __contains__(self, key: K) -> bool:
+        return key in self.__data
+
+    def get(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        try:
+            value = self.__data[key]
+        except KeyError:
+            self.misses += 1
+            return default
+        self.__data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def set(self, key: K, value: V):
+        size = self.__sizeof(value) if self.maxbytes else 0
+        if self.maxbytes and size > self.maxbytes:
+            return
+        if self.__on_evict and key in self.__data:
+            self.__on_evict(key, self.__data[key])
+        self.pop(key)
+        self.__data[key] = value
+        self.__sizes[key] = size
+        self.nbytes += size
+        while self.__data and (
+            (self.maxsize and len(self.__data) > self.maxsize)
+            or (self.maxbytes and self.nbytes > self.maxbytes)
+        ):
+            old_key, old_value = self.__data.popitem(last=False)
+            self.nbytes -= self.__sizes.pop(old_key)
+            self.evictions += 1
+            if self.__on_evict:
+                self.__on_evict(old_key, old_value)
+
+    def pop(self, key: K, default: Optional[V] = None) -> Optional[V]:
+        if key not in self.__data:
+            return default
+        self.nbytes -= self.__sizes.pop(key)
+        return self.__data.pop(key)
+
+    def clear(self):
+        if self.__on_evict:
+            for key, value in self.__data.items():
+                self.__on_evict(key, value)
+        self.__data.clear()
+        self.__sizes.clear()
+        self.nbytes = 0
+
+
+class SingleFlight(Generic[K, V]):
+    """同一个键同时只执行一次，期间的其他调用等待并共享结果（包括异常）"""
+
+    def __init__(self):
+        self.__futures: Dict[K, "asyncio.Future[V]"] = {}
+        self.shared = 0
+
+    def __len__(self) -> int:
+        return len(self.__futures)
+
+    async def do(self, key: K, func: Callable[[], Awaitable[V]]) -> V:
+        future = self.__futures.get(key)
+        if future is None:
+            future = asyncio.ensure_future(func())
+            self.__futures[key] = future
+            future.add_done_callback(lambda _: self.__futures.pop(key, None))
+        else:
+            self.shared += 1
+        # 某个调用方被取消时不影响其他等待者
+        return await asyncio.shield(future)
+
+
+class DiskCache:
+    """memes_cache_dir 的磁盘缓存
+
+    每类缓存放在各自的子目录中，共用一份容量和文件数预算，超出时按 LRU 或 LFU 淘汰。
+    写入先写临时文件再改名，读写都在线程池中进行。启动时扫描目录重建索引，
+    扫描完成前未建立索引的文件会直接尝试读取。
+    """
+
+    def __init__(
+        self,
+        root: Path,
+        maxbytes: int = 0,
+        maxsize: int = 0,
+        policy: str = "lru",
+    ):
+        self.root = root
+        self.maxbytes = maxbytes
+        self.maxsize = maxsize
+        self.policy = policy
+        # key -> [文件大小, 命中次数]，顺序即最近使用顺序
+        self.__entries: "OrderedDict[str, List[int]]" = OrderedDict()
+        self.__scanned = False
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self) -> int:
+        return len(self.__entries)
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "entries": len(self.__entries),
+            "bytes": self.nbytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+        }
+
+    def __touch(self, key: str, size: int):
+        entry = self.__entries.get(key)
+        if entry is None:
+            self.__entries[key] = [size, 1]
+            self.nbytes += size
+            return
+        self.nbytes += size - entry[0]
+        entry[0] = size
+        entry[1] += 1
+        self.__entries.move_to_end(key)
+
+    def __forget(self, key: str):
+        if entry := self.__entries.pop(key, None):
+            self.nbytes -= entry[0]
+
+    def __select_victims(self) -> List[str]:
+        victims = []
+        while self.__entries and (
+            (self.maxsize and len(self.__entries) > self.maxsize)
+            or (self.maxbytes and self.nbytes > self.maxbytes)
+        ):
+            if self.policy == "lfu":
+                key = min(self.__entries, key=lambda k: self.__entries[k][1])
+            else:
+                key = next(iter(self.__entries))
+            self.__forget(key)
+            victims.append(key)
+        self.evictions += len(victims)
+        return victims
+
+    def __read(self, key: str) -> bytes:
+        path = self.root / key
+        data = path.read_bytes()
+        # 记录访问时间，重启后扫描仍能保持大致的 LRU 顺序
+        os.utime(path)
+        return data
+
+    def __write(self, key: str, data: bytes, victims: List[str]):
+        path = self.root / key
+        path.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = path.with_name(f".{path.name}.{uuid.uuid4().hex}.tmp")
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+        self.__remove(victims)
+
+    def __remove(self, keys: List[str]):
+        for key in keys:
+            try:
+                (self.root / key).unlink()
+            except FileNotFoundError:
+                pass
+            except OSError as e:
+                hoshino.logger.warning(f"删除缓存文件 {key} 失败: {e}")
+
+    async def get(self, namespace: str, name: str) -> Optional[bytes]:
+        key = f"{namespace}/{name}"
+        if key not in self.__entries and self.__scanned:
+            self.misses += 1
+            return None
+        try:
+            data = await run_sync_func(self.__read, key)
+        except OSError:
+            self.__forget(key)
+            self.misses += 1
+            return None
+        self.__touch(key, len(data))
+        self.hits += 1
+        return data
+
+    async def set(self, namespace: str, name: str, data: bytes):
+        key = f"{namespace}/{name}"
+        if self.maxbytes and len(data) > self.maxbytes:
+            return
+        self.__touch(key, len(data))
+        victims = [victim for victim in self.__select_victims() if victim != key]
+        try:
+            await run_sync_func(self.__write, key, data, victims)
+        except OSError as e:
+            self.__forget(key)
+            hoshino.logger.warning(f"写入缓存文件 {key} 失败: {e}")
+
+    def __clear(self, keys: List[str], namespace: str):
+        self.__remove(keys)
+        # 扫描前尚未建立索引的文件也一并删除
+        path = self.root / namespace
+        if path.is_dir():
+            for file in os.scandir(path):
+                if file.is_file() and not file.name.startswith("."):
+                    os.remove(file.path)
+
+    async def clear(self, namespace: str):
+        keys = [key for key in self.__entries if key.startswith(f"{namespace}/")]
+        for key in keys:
+            self.__forget(key)
+        await run_sync_func(self.__clear, keys, namespace)
+
+    def __scan(self) -> List[Tuple[str, int]]:
+        files: List[Tuple[float, str, int]] = []
+        if not self.root.exists():
+            return []
+        for entry in os.scandir(self.root):
+            # 旧版本直接放在根目录下的表情列表缓存
+            if entry.is_file() and re.fullmatch(r"[0-9a-f]{32}\.jpg", entry.name):
+                os.remove(entry.path)
+                continue
+            if not entry.is_dir() or entry.name.startswith((".", "_")):
+                continue
+            for file in os.scandir(entry.path):
+                if not file.is_file():
+                    continue
+                stat = file.stat()
+                if file.name.startswith("."):
+                    # 写入中断留下的临时文件
+                    if file.name.endswith(".tmp") and stat.st_mtime < time.time() - 60:
+                        os.remove(file.path)
+                    continue
+                files.append((stat.st_mtime, f"{entry.name}/{file.name}", stat.st_size))
+        files.sort()
+        return [(key, size) for _, key, size in files]
+
+    async def scan(self):
+        files = await run_sync_func(self.__scan)
+        entries: "OrderedDict[str, List[int]]" = OrderedDict(
+            (key, [size, 0]) for key, size in files if key not in self.__entries
+        )
+        entries.update(self.__entries)
+        self.__entries = entries
+        self.nbytes = sum(entry[0] for entry in entries.values())
+        self.__scanned = True
+        victims = self.__select_victims()
+        if victims:
+            await run_sync_func(self.__remove, victims)
+        hoshino.logger.info(
+            f"表情缓存目录共 {len(self.__entries)} 个文件，{self.nbytes / 10 ** 6:.1f}MB"
+            + (f"，清理了 {len(victims)} 个文件" if victims else "")
+        )
+
+
+disk_cache = DiskCache(
+    memes_cache_dir,
+    maxbytes=int(memes_cache_max_size * 10 ** 6),
+    maxsize=memes_cache_max_entries,
+    policy=memes_cache_policy,
+)
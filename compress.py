@@ -0,0 +1,138 @@
+import math
+from io import BytesIO
+from typing import List, Optional
+
+from PIL import Image, ImageSequence
+
+from .config import memes_output_max_size
+
+# 每张图片最多尝试的编码次数
+MAX_ATTEMPTS = 6
+
+
+def has_alpha(img: Image.Image) -> bool:
+    if img.mode == "P":
+        return "transparency" in img.info
+    if img.mode not in ("RGBA", "LA"):
+        return False
+    return img.getchannel("A").getextrema()[0] < 255
+
+
+def _resize(img: Image.Image, scale: float) -> Image.Image:
+    if scale >= 1:
+        return img
+    size = (max(round(img.width * scale), 1), max(round(img.height * scale), 1))
+    return img.resize(size, Image.LANCZOS)
+
+
+def _encode_jpeg(img: Image.Image, quality: int) -> bytes:
+    output = BytesIO()
+    img.save(output, format="JPEG", quality=quality, optimize=True)
+    return output.getvalue()
+
+
+def _encode_png(img: Image.Image, colors: int) -> bytes:
+    output = BytesIO()
+    img.quantize(colors, method=Image.FASTOCTREE).save(output, format="PNG", optimize=True)
+    return output.getvalue()
+
+
+def _fit_static(img: Image.Image, max_size: int) -> Optional[bytes]:
+    """透明或颜色很少的图片用调色板 PNG，照片类的用 JPEG，都放不下时再缩小"""
+    img = img.convert("RGBA") if has_alpha(img) else img.convert("RGB")
+    graphic = img.mode == "RGBA" or img.getcolors(256) is not None
+    best: Optional[bytes] = None
+    scale = 1.0
+    for _ in range(MAX_ATTEMPTS):
+        frame = _resize(img, scale)
+        if graphic:
+            for colors in (256, 64):
+                data = _encode_png(frame, colors)
+                if best is None or len(data) < len(best):
+                    best = data
+                if len(data) <= max_size:
+                    return data
+        else:
+            # 在 40 ~ 90 之间二分查找放得下的最高质量
+            low, high = 40, 90
+            while low <= high:
+                quality = (low + high) // 2
+                data = _encode_jpeg(frame, quality)
+                if best is None or len(data) < len(best):
+                    best = data
+                if len(data) <= max_size:
+                    result = data
+                    low = quality + 1
+                else:
+                    high = quality - 1
+            if low > 40:
+                return result
+        scale *= max(min(math.sqrt(max_size / len(best)) * 0.9, 0.9), 0.5)
+    return best
+
+
+def _encode_gif(frames: List[Image.Image], durations: List[int], colors: int, loop: int) -> bytes:
+    if colors < 256 and not any(has_alpha(frame) for frame in frames):
+        frames = [frame.convert("RGB").quantize(colors, method=Image.FASTOCTREE) for frame in frames]
+    output = BytesIO()
+    frames[0].save(
+        output,
+        format="GIF",
+        save_all=True,
+        append_images=frames[1:],
+        duration=durations,
+        loop=loop,
+        disposal=2,
+    )
+    return output.getvalue()
+
+
+def _fit_animated(img: Image.Image, size: int, max_size: int) -> Optional[bytes]:
+    """依次减少颜色数、隔帧抽帧、缩小尺寸，每次按上一次的大小估计还需要压缩多少"""
+    frames: List[Image.Image] = []
+    durations: List[int] = []
+    for frame in ImageSequence.Iterator(img):
+        frames.append(frame.convert("RGBA"))
+        durations.append(frame.info.get("duration") or 100)
+    loop = img.info.get("loop", 0)
+
+    best: Optional[bytes] = None
+    colors, step, scale = 256, 1, 1.0
+    for _ in range(MAX_ATTEMPTS):
+        ratio = max_size / size
+        if colors == 256 and ratio > 0.6:
+            colors = 128
+        elif step == 1 and len(frames) >= 20 and ratio > 0.35:
+            step = 2
+        else:
+            scale *= max(min(math.sqrt(ratio) * 0.9, 0.9), 0.5)
+
+        selected: List[Image.Image] = []
+        selected_durations: List[int] = []
+        for i in range(0, len(frames), step):
+            selected.append(_resize(frames[i], scale))
+            selected_durations.append(sum(durations[i:i + step]))
+        data = _encode_gif(selected, selected_durations, colors, loop)
+        size = len(data)
+        if best is None or size < len(best):
+            best = data
+        if size <= max_size:
+            return data
+    return best
+
+
+def fit_output(data: bytes, max_size: int = int(memes_output_max_size * 10 ** 6)) -> bytes:
+    """把制作结果压缩到 `max_size` 字节以内（为 0 时不压缩），做不到时返回能得到的最小结果"""
+    if not max_size or len(data) <= max_size:
+        return data
+    try:
+        img = Image.open(BytesIO(data))
+        if getattr(img, "is_animated", False):
+            result = _fit_animated(img, len(data), max_size)
+        else:
+            result = _fit_static(img, max_size)
+    except Exception:
+        return data
+    if result is None or len(result) >= len(data):
+        return data
+    return result
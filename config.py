@@ -1,5 +1,5 @@
 from pathlib import Path
-from typing import List
+from typing import Dict, List
 from meme_generator.config import meme_config
 
 meme_command_start: str = ""  # 命令前缀
@@ -17,14 +17,110 @@ memes_normal_error: bool = (
     False  # 是否输出表情的相关错误提示，如获取图片失败、表情不存在等（谨慎使用，容易误触发）
 )
 meme_disabled_list: List[str] = []  # 禁用的表情包列表，填写表情的 `key`
+memes_permission_backend: str = "sqlite"  # 表情开关的存储方式，可选 `sqlite` / `yaml`
+memes_permission_commit_delay: float = 1.0  # 表情开关改动合并写入前等待的秒数
+memes_permission_yaml_export: bool = False  # 使用 sqlite 时，是否同时把表情开关导出到 config.yml 方便查看
+
+memes_help_cache_size: int = 32  # 内存中缓存的表情列表图片数量
+memes_cache_max_size: float = 200  # memes_cache_dir 磁盘缓存的容量上限，单位为 MB，0 为不限制
+memes_cache_max_entries: int = 2000  # memes_cache_dir 磁盘缓存的文件数上限，0 为不限制
+memes_cache_policy: str = "lru"  # 磁盘缓存的淘汰策略，可选 `lru` / `lfu`
+memes_preview_cache_size: int = 64  # 内存中缓存的表情预览图数量
+memes_preview_on_startup: bool = False  # 是否在启动完成后于后台预先生成全部表情的预览图（会导入全部按需加载的表情）
+memes_lazy_load: bool = True  # 是否按需加载 `meme_dirs` 中的表情，只在首次触发或预览时导入对应模块
+memes_warm_up_on_startup: bool = False  # 按需加载时，是否在启动完成后于后台预先导入全部表情
+memes_rate_limit_user_capacity: float = 5  # 每个用户的令牌桶容量，即可以连续制作的表情数，0 为不限制
+memes_rate_limit_user_rate: float = 0.2  # 每个用户每秒恢复的令牌数，0 为不限制
+memes_rate_limit_group_capacity: float = 20  # 每个群的令牌桶容量，0 为不限制
+memes_rate_limit_group_rate: float = 1  # 每个群每秒恢复的令牌数，0 为不限制
+memes_rate_limit_costs: Dict[str, float] = {}  # 制作表情消耗的令牌数，默认为 1，可按表情的 `key` 或标签设置
+memes_rate_limit_reply: str = "表情做得太快了，请 {wait} 秒后再试~"  # 超出频率限制时的回复，等待期间只回复一次，为空时不回复
+memes_render_engine: str = "thread"  # 表情制作方式，可选 `thread`（线程池）/ `process`（进程池，可同时使用多个核心）
+memes_render_workers: int = 0  # 进程池的进程数，0 为 CPU 核心数
+memes_render_timeout: float = 30  # 制作单个表情的时限，单位为秒，0 为不限制
+memes_render_timeouts: Dict[str, float] = {}  # 单独设置某些表情的制作时限，填写表情的 `key`
+memes_render_timeout_reply: str = "表情制作超时了，换张小一点的图片试试吧~"  # 制作超时时的回复，为空时不回复
+memes_render_concurrency: int = 4  # 同时制作的表情数上限，0 为不限制
+memes_render_group_concurrency: int = 2  # 每个群同时制作的表情数上限，0 为不限制
+memes_render_queue_size: int = 32  # 排队等待制作的请求数上限，超出时直接拒绝，0 为不限制
+memes_render_queue_timeout: float = 15  # 排队等待制作的最长时间，单位为秒，0 为不限制
+memes_render_busy_reply: str = "表情制作繁忙，请稍后再试~"  # 因排队过多而拒绝请求时的回复，为空时不回复
+memes_image_max_size: int = 1024  # 输入图片的最长边上限，制作前会先缩小到此尺寸以内，0 为不缩小
+memes_image_max_sizes: Dict[str, int] = {}  # 单独设置某些表情的输入图片尺寸上限，填写表情的 `key`
+memes_image_max_frames: int = 100  # 输入动图的最大帧数，超出时均匀抽帧，0 为不限制
+memes_image_max_duration: float = 10  # 输入动图的最长时长，单位为秒，超出部分截掉，0 为不限制
+memes_image_max_fps: float = 25  # 输入动图的最大帧率，超出时均匀抽帧，0 为不限制
+memes_output_max_size: float = 5  # 制作结果的大小上限，单位为 MB，超出时重新压缩，0 为不压缩
+memes_send_mode: str = "base64"  # 发送图片的方式，可选 `base64` / `file`（本地文件）/ `http`（由 bot 的 web 服务提供）
+memes_send_dir: str = ""  # `file` / `http` 方式存放待发送图片的目录，默认为 memes_cache_dir/_send
+memes_send_url: str = ""  # `http` 方式中 OneBot 实现访问 bot 的地址，如 `http://127.0.0.1:8080`
+memes_send_ttl: float = 600  # 待发送的图片在此时间内没有再次发送时删除，单位为秒
+memes_render_cache_memory_size: float = 64  # 内存中制作结果缓存的容量上限，单位为 MB，0 为不缓存
+memes_render_cache_disk: bool = True  # 是否同时把制作结果缓存到 memes_cache_dir
+# 结果带有随机性、不缓存制作结果的表情，填写表情的 `key`；默认为内置表情和 `mahoo` 中带有随机性的表情
+memes_render_cache_exclude: List[str] = [
+    "always_like",
+    "atri_pillow",
+    "crawl",
+    "dont_touch",
+    "douyin",
+    "fade_away",
+    "firefly_holdsign",
+    "flush",
+    "genshin_eat",
+    "jinhsi",
+    "kokona_say",
+    "kokona_seal",
+    "mahoo",
+    "name_generator",
+    "p5letter",
+    "repeat",
+    "shake_head",
+    "shock",
+    "throw",
+    "turn",
+]
+memes_fetch_concurrency: int = 4  # 同一条指令中同时下载的图片数
+memes_fetch_deadline: float = 30  # 同一条指令中全部图片的下载时限，单位为秒，0 为不限制
+memes_image_cache_ttl: float = 600  # 下载的图片（头像等）在此时间内直接使用缓存，之后向服务器重新验证，单位为秒
+memes_image_cache_memory_size: float = 32  # 内存中图片缓存的容量上限，单位为 MB，0 为不限制
+memes_image_cache_disk: bool = True  # 是否同时把下载的图片缓存到 memes_cache_dir
+memes_download_retries: int = 3  # 下载失败时的最多尝试次数
+memes_download_backoff: float = 0.5  # 下载重试的初始退避时间，之后每次翻倍并加上随机抖动，单位为秒
+memes_download_backoff_max: float = 8  # 下载重试的最长退避时间，单位为秒
+memes_breaker_threshold: int = 5  # 同一主机连续下载失败多少次后暂停请求，0 为不熔断
+memes_breaker_cooldown: float = 30  # 熔断后暂停请求的时间，单位为秒
+memes_hedge_percentile: float = 0  # 下载耗时超过该主机近期耗时的此分位数（如 0.9）时再发一个相同请求，0 为不开启
+memes_download_max_size: float = 10  # 单张图片的下载大小上限，单位为 MB，0 为不限制
+memes_http_timeout: float = 20  # 单次下载的总超时，单位为秒
+memes_http_connect_timeout: float = 5  # 建立连接的超时，单位为秒
+memes_http_limit: int = 100  # 下载连接池的最大连接数
+memes_http_limit_per_host: int = 10  # 下载连接池对同一主机的最大连接数
+memes_http_dns_ttl: int = 300  # DNS 解析结果的缓存时间，单位为秒
+memes_http_keepalive: float = 30  # 空闲连接的保持时间，单位为秒
+memes_user_info_ttl: float = 300  # 群成员信息的缓存时间，单位为秒
+memes_user_info_negative_ttl: float = 60  # 查询失败的用户信息的缓存时间，单位为秒
+memes_user_info_cache_size: int = 4096  # 缓存的用户信息条数
+memes_user_info_bulk_load: bool = False  # 是否在群里首次查询用户信息时一次性加载整个群的成员列表
+memes_message_cache_ttl: float = 60  # 回复消息时查询到的原消息的缓存时间，单位为秒
+memes_message_cache_size: int = 256  # 缓存的原消息条数
 
 baidu_trans_appid: str = ""
 baidu_trans_apikey: str = ""
 
-meme_config.translate.baidu_trans_appid = baidu_trans_appid
-meme_config.translate.baidu_trans_apikey = baidu_trans_apikey
-meme_config.meme.meme_dirs = [
+meme_dirs: List[str] = [
     str(Path(__file__).parent / "meme_optional"),  # 本地额外表情包目录
     # str(Path(__file__).parent / "meme-generator-contrib" / "memes"),
 ]  # 第三方表情包目录
-meme_config.dump()
+
+# meme-generator 导入时已经按自身配置加载过的表情目录，插件不再重复加载
+meme_loaded_dirs: List[str] = [str(meme_dir) for meme_dir in meme_config.meme.meme_dirs]
+# 表情目录由插件自己加载；meme-generator 的配置只在有变化时于启动完成后写回，导入插件时不写文件
+memes_config_changed: bool = (
+    meme_config.translate.baidu_trans_appid != baidu_trans_appid
+    or meme_config.translate.baidu_trans_apikey != baidu_trans_apikey
+    or bool(meme_loaded_dirs)
+)
+meme_config.translate.baidu_trans_appid = baidu_trans_appid
+meme_config.translate.baidu_trans_apikey = baidu_trans_apikey
+meme_config.meme.meme_dirs = []
@@ -1,6 +1,8 @@
 
+from .fetch import fetch_images as fetch_images
 from .image_source import ImageSource as ImageSource
 from .user_info import UserInfo as UserInfo
 from .user_info import get_user_info as get_user_info
+from .user_info import get_user_infos as get_user_infos
 from .utils import check_qq_number as check_qq_number
 from .utils import get_content as get_content
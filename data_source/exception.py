@@ -1,2 +1,11 @@
 class NetworkError(Exception):
     pass
+
+
+class DownloadRejectedError(NetworkError):
+    """下载内容不是图片或超出大小限制，`reason` 会提示给用户"""
+
+    def __init__(self, url: str, reason: str):
+        super().__init__(f"{url} {reason}")
+        self.url = url
+        self.reason = reason
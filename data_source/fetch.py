@@ -0,0 +1,42 @@
+import asyncio
+from typing import Dict, List, Sequence
+
+from .exception import NetworkError
+from .image_source import ImageSource
+
+
+async def fetch_images(
+    image_sources: Sequence[ImageSource],
+    concurrency: int = 4,
+    deadline: float = 0,
+) -> List[bytes]:
+    """并发获取图片，结果与 `image_sources` 顺序一致
+
+    相同来源（如同一个人的头像出现两次）只下载一次；
+    `deadline` 为整个请求的时限，单位为秒，为 0 时不限制。
+    """
+    semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+    async def fetch(image_source: ImageSource) -> bytes:
+        async with semaphore:
+            return await image_source.get_image()
+
+    tasks: Dict[str, "asyncio.Task[bytes]"] = {}
+    keys: List[str] = []
+    for image_source in image_sources:
+        key = image_source.identity()
+        keys.append(key)
+        if key not in tasks:
+            tasks[key] = asyncio.ensure_future(fetch(image_source))
+    if not tasks:
+        return []
+
+    try:
+        results = await asyncio.wait_for(asyncio.gather(*tasks.values()), deadline or None)
+    except asyncio.TimeoutError:
+        raise NetworkError(f"图片下载超时（{deadline:g}秒）")
+    finally:
+        for task in tasks.values():
+            task.cancel()
+    images = dict(zip(tasks, results))
+    return [images[key] for key in keys]
@@ -0,0 +1,116 @@
+from typing import Dict, Mapping, NamedTuple, Optional
+
+from aiohttp import ClientSession, ClientTimeout, TCPConnector
+from nonebot import get_bot
+
+from hoshino import logger
+from .exception import DownloadRejectedError
+from ..config import (
+    memes_download_max_size,
+    memes_http_connect_timeout,
+    memes_http_dns_ttl,
+    memes_http_keepalive,
+    memes_http_limit,
+    memes_http_limit_per_host,
+    memes_http_timeout,
+)
+
+headers = {
+    "User-Agent": "Mozilla/5.0 (Windows; U; Windows NT 5.1; zh-CN; rv:1.9.1.6) ",
+    "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+    "Accept-Language": "zh-cn"
+}
+
+_session: Optional[ClientSession] = None
+
+IMAGE_SIGNATURES = (
+    b"\xff\xd8\xff",  # jpeg
+    b"\x89PNG\r\n\x1a\n",
+    b"GIF87a",
+    b"GIF89a",
+    b"BM",
+    b"II*\x00",  # tiff
+    b"MM\x00*",
+    b"\x00\x00\x01\x00",  # ico
+)
+CHUNK_SIZE = 64 * 1024
+
+
+def get_session() -> ClientSession:
+    """所有下载共用的连接池，复用连接、DNS 解析和 TLS 会话
+
+    在事件循环中首次调用时创建，bot 停止时关闭。
+    """
+    global _session
+    if _session is None or _session.closed:
+        _session = ClientSession(
+            connector=TCPConnector(
+                limit=memes_http_limit,
+                limit_per_host=memes_http_limit_per_host,
+                ttl_dns_cache=memes_http_dns_ttl,
+                keepalive_timeout=memes_http_keepalive,
+            ),
+            timeout=ClientTimeout(
+                total=memes_http_timeout,
+                sock_connect=memes_http_connect_timeout,
+            ),
+            headers=headers,
+        )
+    return _session
+
+
+class Response(NamedTuple):
+    status: int
+    content: bytes
+    headers: Mapping[str, str]
+
+
+def is_image(data: bytes) -> bool:
+    if data.startswith(IMAGE_SIGNATURES):
+        return True
+    # webp / heic / avif
+    return (data[:4] == b"RIFF" and data[8:12] == b"WEBP") or data[4:8] == b"ftyp"
+
+
+async def get_response(
+    url: str,
+    headers: Optional[Dict[str, str]] = None,
+    max_size: int = int(memes_download_max_size * 10 ** 6),
+) -> Response:
+    """发出一次请求，不检查状态码也不重试，一般应通过 `download_policy` 调用
+
+    2xx 的响应分块读取：声明的长度或实际读到的内容超过 `max_size`（为 0 时不限制），
+    或开头不是常见图片格式时，立即中止下载并抛出 `DownloadRejectedError`。
+    其他响应（304、错误页面等）只需要状态码，不读取内容。
+    """
+    async with get_session().get(url, headers=headers) as resp:
+        if not 200 <= resp.status < 300:
+            return Response(resp.status, b"", resp.headers)
+        if max_size and (resp.content_length or 0) > max_size:
+            raise DownloadRejectedError(
+                url, f"图片太大了（{resp.content_length / 10 ** 6:.1f}MB），最大支持 {max_size / 10 ** 6:g}MB"
+            )
+        data = bytearray()
+        sniffed = False
+        async for chunk in resp.content.iter_chunked(CHUNK_SIZE):
+            data += chunk
+            if not sniffed and len(data) >= 16:
+                if not is_image(bytes(data[:16])):
+                    raise DownloadRejectedError(url, "下载的内容不是图片")
+                sniffed = True
+            if max_size and len(data) > max_size:
+                raise DownloadRejectedError(url, f"图片太大了，最大支持 {max_size / 10 ** 6:g}MB")
+        if not sniffed and not is_image(bytes(data)):
+            raise DownloadRejectedError(url, "下载的内容不是图片")
+        return Response(resp.status, bytes(data), resp.headers)
+
+
+async def close_session():
+    global _session
+    if _session is not None and not _session.closed:
+        await _session.close()
+        logger.info("表情下载连接池已关闭")
+    _session = None
+
+
+get_bot().server_app.after_serving(close_session)
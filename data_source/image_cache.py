@@ -0,0 +1,123 @@
+import hashlib
+import pickle
+import time
+from typing import Dict, NamedTuple, Optional, Tuple
+
+from hoshino import logger
+from ..cache import LRUCache, SingleFlight, disk_cache
+from ..config import (
+    memes_image_cache_disk,
+    memes_image_cache_memory_size,
+    memes_image_cache_ttl,
+)
+from .exception import NetworkError
+from .policy import download_policy
+
+
+class CachedImage(NamedTuple):
+    content: bytes
+    expires: float
+    etag: str = ""
+    last_modified: str = ""
+
+    def validators(self) -> Dict[str, str]:
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+
+class ImageCache:
+    """图片来源共用的内容缓存
+
+    以图片链接为键（链接中已包含 qq 号与尺寸、emoji 与样式等信息），
+    先查内存再查 memes_cache_dir/image。超过 `ttl` 后带上 ETag / Last-Modified
+    重新验证，服务器返回 304 时继续使用缓存；验证失败时也先使用旧图片。
+    """
+
+    def __init__(self, ttl: float = 600, maxbytes: int = 0, disk: bool = True):
+        self.ttl = ttl
+        self.disk = disk
+        self.__memory: LRUCache[str, CachedImage] = LRUCache(
+            0, maxbytes, sizeof=lambda entry: len(entry.content)
+        )
+        # qq -> (是否为默认头像, 过期时间)
+        self.__default_avatars: LRUCache[int, Tuple[bool, float]] = LRUCache(4096)
+        # 同一链接的并发请求只下载一次
+        self.flight: SingleFlight[str, bytes] = SingleFlight()
+
+    @staticmethod
+    def __name(url: str) -> str:
+        return hashlib.md5(url.encode("utf8")).hexdigest()
+
+    async def __get(self, url: str) -> Optional[CachedImage]:
+        if entry := self.__memory.get(url):
+            return entry
+        if not self.disk:
+            return None
+        data = await disk_cache.get("image", self.__name(url))
+        if data is None:
+            return None
+        try:
+            entry = CachedImage(*pickle.loads(data))
+        except Exception:
+            return None
+        self.__memory.set(url, entry)
+        return entry
+
+    async def __set(self, url: str, entry: CachedImage):
+        self.__memory.set(url, entry)
+        if self.disk:
+            await disk_cache.set(
+                "image", self.__name(url), pickle.dumps(tuple(entry), protocol=pickle.HIGHEST_PROTOCOL)
+            )
+
+    async def fetch(self, url: str) -> bytes:
+        return await self.flight.do(url, lambda: self.__fetch(url))
+
+    async def __fetch(self, url: str) -> bytes:
+        entry = await self.__get(url)
+        now = time.time()
+        if entry and entry.expires > now:
+            return entry.content
+
+        try:
+            resp = await download_policy.request(url, entry.validators() if entry else None)
+        except NetworkError as e:
+            if entry:
+                logger.warning(f"图片缓存重新验证失败，使用旧图片 {url}: {e}")
+                return entry.content
+            raise
+
+        if resp.status == 304 and entry:
+            await self.__set(url, entry._replace(expires=now + self.ttl))
+            return entry.content
+        await self.__set(
+            url,
+            CachedImage(
+                resp.content,
+                now + self.ttl,
+                resp.headers.get("ETag", ""),
+                resp.headers.get("Last-Modified", ""),
+            ),
+        )
+        return resp.content
+
+    def is_default_avatar(self, qq: int) -> Optional[bool]:
+        """上次判断的 qq 是否使用默认头像，过期或未判断过时返回 None"""
+        memo = self.__default_avatars.get(qq)
+        if memo is None or memo[1] <= time.time():
+            return None
+        return memo[0]
+
+    def set_default_avatar(self, qq: int, is_default: bool):
+        self.__default_avatars.set(qq, (is_default, time.time() + self.ttl))
+
+
+image_cache = ImageCache(
+    memes_image_cache_ttl,
+    maxbytes=int(memes_image_cache_memory_size * 10 ** 6),
+    disk=memes_image_cache_disk,
+)
@@ -6,7 +6,7 @@ import emoji
 from pydantic import BaseModel
 from strenum import StrEnum
 from .compat import PYDANTIC_V2
-from .utils import download_url
+from .image_cache import image_cache
 
 
 class ImageSource(BaseModel):
@@ -16,6 +16,13 @@ class ImageSource(BaseModel):
     async def get_image(self) -> bytes:
         raise NotImplementedError
 
+    def identity(self) -> str:
+        # 用于合并同一请求中重复的图片来源
+        try:
+            return f"{type(self).__name__}:{self.get_url()}"
+        except NotImplementedError:
+            return f"{type(self).__name__}:{id(self)}"
+
 
 class ImageUrl(ImageSource):
     url: str
@@ -24,7 +31,7 @@ class ImageUrl(ImageSource):
         return self.url
 
     async def get_image(self) -> bytes:
-        return await download_url(self.url)
+        return await image_cache.fetch(self.url)
 
 
 class EmojiStyle(StrEnum):
@@ -68,7 +75,7 @@ class Emoji(ImageSource):
 
     async def get_image(self, style: EmojiStyle = EmojiStyle.Apple) -> bytes:
         url = self.get_url(style)
-        return await download_url(url)
+        return await image_cache.fetch(url)
 
 
 class QQAvatar(ImageSource):
@@ -78,11 +85,15 @@ class QQAvatar(ImageSource):
         return f"https://q1.qlogo.cn/g?b=qq&nk={self.qq}&s={size}"
 
     async def get_image(self) -> bytes:
-        url = self.get_url(size=640)
-        data = await download_url(url)
-        if hashlib.md5(data).hexdigest() == "acef72340ac0e914090bd35799f5594e":
-            url = self.get_url(size=100)
-            data = await download_url(url)
+        # 默认头像的 640 尺寸是一张占位图，需要改用 100 尺寸
+        is_default = image_cache.is_default_avatar(self.qq)
+        if is_default is not None:
+            return await image_cache.fetch(self.get_url(size=100 if is_default else 640))
+        data = await image_cache.fetch(self.get_url(size=640))
+        is_default = hashlib.md5(data).hexdigest() == "acef72340ac0e914090bd35799f5594e"
+        image_cache.set_default_avatar(self.qq, is_default)
+        if is_default:
+            data = await image_cache.fetch(self.get_url(size=100))
         return data
 
 
@@ -95,7 +106,7 @@ class QQAvatarOpenId(ImageSource):
 
     async def get_image(self) -> bytes:
         url = self.get_url()
-        return await download_url(url)
+        return await image_cache.fetch(url)
 
 
 class TelegramFile(ImageSource):
@@ -111,7 +122,7 @@ class TelegramFile(ImageSource):
         if Path(self.file_path).exists():
             return await anyio.Path(self.file_path).read_bytes()
         url = self.get_url(api_server)
-        return await download_url(url)
+        return await image_cache.fetch(url)
 
 
 class DiscordImageFormat(StrEnum):
@@ -143,4 +154,4 @@ class DiscordUserAvatar(ImageSource):
         image_size: int = 1024,
     ) -> bytes:
         url = self.get_url(base_url, image_format, image_size)
-        return await download_url(url)
+        return await image_cache.fetch(url)
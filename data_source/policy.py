@@ -0,0 +1,157 @@
+import asyncio
+import random
+import time
+from collections import deque
+from typing import Deque, Dict, List, Optional
+from urllib.parse import urlsplit
+
+from aiohttp import ClientError
+
+from hoshino import logger
+from ..config import (
+    memes_breaker_cooldown,
+    memes_breaker_threshold,
+    memes_download_backoff,
+    memes_download_backoff_max,
+    memes_download_retries,
+    memes_hedge_percentile,
+)
+from .exception import NetworkError
+from .http import Response, get_response
+
+# 这些状态码说明服务器暂时不可用，可以重试；其他 4xx 重试也没有意义
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+class StatusError(NetworkError):
+    def __init__(self, url: str, status: int):
+        super().__init__(f"{url} 返回了状态码 {status}")
+        self.status = status
+
+
+class HostState:
+    """单个主机的熔断状态和近期耗时"""
+
+    def __init__(self):
+        self.failures = 0
+        # 熔断结束时间，为 0 时未熔断；已过期但不为 0 时处于半开状态
+        self.opened_until = 0.0
+        self.probing = False
+        self.latencies: Deque[float] = deque(maxlen=100)
+
+    def percentile(self, q: float) -> Optional[float]:
+        if len(self.latencies) < 20:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(int(len(latencies) * q), len(latencies) - 1)]
+
+
+class DownloadPolicy:
+    """下载策略：检查状态码、指数退避重试、按主机熔断、可选的对冲请求
+
+    连续失败 `breaker_threshold` 次后，该主机在 `breaker_cooldown` 秒内直接失败，
+    冷却结束后只放行一个请求试探，试探期间其他请求仍直接失败；试探成功则恢复，再失败则重新熔断。开启对冲时，请求耗时超过该主机
+    近期耗时的 `hedge_percentile` 分位数后再发出一个相同请求，取先成功的结果。
+    """
+
+    def __init__(
+        self,
+        retries: int = 3,
+        backoff: float = 0.5,
+        backoff_max: float = 8,
+        breaker_threshold: int = 5,
+        breaker_cooldown: float = 30,
+        hedge_percentile: float = 0,
+    ):
+        self.retries = max(retries, 1)
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.hedge_percentile = hedge_percentile
+        self.__hosts: Dict[str, HostState] = {}
+        self.hedged = 0
+
+    def __delay(self, attempt: int) -> float:
+        return random.uniform(0, min(self.backoff_max, self.backoff * 2 ** attempt))
+
+    def __failed(self, host: str, state: HostState):
+        state.failures += 1
+        if self.breaker_threshold and state.failures >= self.breaker_threshold:
+            state.opened_until = time.monotonic() + self.breaker_cooldown
+            logger.warning(f"{host} 连续 {state.failures} 次下载失败，{self.breaker_cooldown:g} 秒内不再请求")
+
+    async def __hedged(self, url: str, headers: Optional[Dict[str, str]], delay: float) -> Response:
+        tasks: List["asyncio.Task[Response]"] = [asyncio.ensure_future(get_response(url, headers))]
+        try:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done:
+                self.hedged += 1
+                tasks.append(asyncio.ensure_future(get_response(url, headers)))
+            while True:
+                done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                error: Optional[BaseException] = None
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+                tasks = list(pending)
+                if not tasks:
+                    raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    async def __attempt(self, url: str, headers: Optional[Dict[str, str]], state: HostState) -> Response:
+        delay = state.percentile(self.hedge_percentile) if self.hedge_percentile else None
+        start = time.monotonic()
+        if delay is None:
+            resp = await get_response(url, headers)
+        else:
+            resp = await self.__hedged(url, headers, delay)
+        if not (200 <= resp.status < 300 or resp.status == 304):
+            raise StatusError(url, resp.status)
+        state.latencies.append(time.monotonic() - start)
+        return resp
+
+    async def request(self, url: str, headers: Optional[Dict[str, str]] = None) -> Response:
+        host = urlsplit(url).hostname or ""
+        state = self.__hosts.setdefault(host, HostState())
+        error: Optional[Exception] = None
+        for attempt in range(self.retries):
+            probe = bool(state.opened_until)
+            if state.opened_until > time.monotonic() or (probe and state.probing):
+                raise NetworkError(f"{host} 暂时不可用，请稍后再试")
+            if probe:
+                state.probing = True
+            try:
+                resp = await self.__attempt(url, headers, state)
+            except StatusError as e:
+                if e.status not in RETRYABLE_STATUS:
+                    raise
+                error = e
+            except (ClientError, asyncio.TimeoutError) as e:
+                error = e
+            else:
+                state.failures = 0
+                state.opened_until = 0
+                return resp
+            finally:
+                if probe:
+                    state.probing = False
+            self.__failed(host, state)
+            if attempt + 1 < self.retries:
+                delay = self.__delay(attempt)
+                logger.warning(f"Error downloading {url}, retry {attempt + 1}/{self.retries} in {delay:.1f}s: {error!r}")
+                await asyncio.sleep(delay)
+        raise NetworkError(f"{url} 下载失败！") from error
+
+
+download_policy = DownloadPolicy(
+    retries=memes_download_retries,
+    backoff=memes_download_backoff,
+    backoff_max=memes_download_backoff_max,
+    breaker_threshold=memes_breaker_threshold,
+    breaker_cooldown=memes_breaker_cooldown,
+    hedge_percentile=memes_hedge_percentile,
+)
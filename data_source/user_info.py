@@ -1,12 +1,30 @@
-from typing import Optional, Union
+import asyncio
+import time
+from typing import Any, Dict, FrozenSet, Iterable, Optional, Tuple, Union
 from aiocqhttp.exceptions import ActionFailed
 from pydantic import BaseModel
 from strenum import StrEnum
 from hoshino import logger, HoshinoBot
 from hoshino.typing import CQEvent
+from ..cache import LRUCache, SingleFlight
+from ..config import (
+    memes_user_info_bulk_load,
+    memes_user_info_cache_size,
+    memes_user_info_negative_ttl,
+    memes_user_info_ttl,
+)
 from .image_source import ImageSource, QQAvatar
 from .utils import check_qq_number
 
+# (群号, qq) -> (群成员信息或陌生人信息, 过期时间)，查询失败时信息为 None
+user_info_cache: LRUCache[Tuple[Any, str], Tuple[Optional[Dict[str, Any]], float]] = LRUCache(
+    memes_user_info_cache_size
+)
+# 已批量加载成员列表的群 -> (成员 qq 集合, 过期时间)，加载失败时集合为 None
+# 成员信息与其他信息共用 user_info_cache，可能被淘汰，是否为群成员以这里为准
+_group_members: Dict[Any, Tuple[Optional[FrozenSet[str]], float]] = {}
+_group_loading: SingleFlight[Any, None] = SingleFlight()
+
 
 class UserGender(StrEnum):
     male = "male"
@@ -33,23 +51,70 @@ def _sex_to_gender(sex: Optional[str]) -> UserGender:
     )
 
 
-async def get_user_info(bot: HoshinoBot, event: CQEvent, user_id: Union[str, int]) -> Optional[UserInfo]:
-    info = None
-    user_id = str(user_id)
-    if not check_qq_number(user_id):
-        return None
+async def _load_group(bot: HoshinoBot, group_id: Any):
     try:
-        info = await bot.get_group_member_info(
-            group_id=event.group_id, user_id=int(user_id)
-        )
+        members = await bot.get_group_member_list(group_id=group_id)
     except ActionFailed as e:
-        logger.warning(f"Error calling get_group_member_info: {e}")
+        logger.warning(f"Error calling get_group_member_list: {e}")
+        _group_members[group_id] = (None, time.time() + memes_user_info_negative_ttl)
+        return
+    expires = time.time() + memes_user_info_ttl
+    for member in members:
+        user_info_cache.set((group_id, str(member["user_id"])), (member, expires))
+    _group_members[group_id] = (frozenset(str(member["user_id"]) for member in members), expires)
+
+
+async def load_group(bot: HoshinoBot, group_id: Any) -> Optional[FrozenSet[str]]:
+    """批量加载群成员信息，同一个群同时只加载一次；返回群成员的 qq，无法获取时返回 None"""
+    members, expires = _group_members.get(group_id, (None, 0))
+    if expires <= time.time():
+        await _group_loading.do(group_id, lambda: _load_group(bot, group_id))
+        members, expires = _group_members.get(group_id, (None, 0))
+    return members
+
+
+async def _fetch_info(
+    bot: HoshinoBot, group_id: Any, user_id: str, member: bool = True
+) -> Optional[Dict[str, Any]]:
+    info = None
+    if member and group_id:
+        try:
+            info = await bot.get_group_member_info(
+                group_id=group_id, user_id=int(user_id)
+            )
+        except ActionFailed as e:
+            logger.warning(f"Error calling get_group_member_info: {e}")
 
     if not info:
         try:
             info = await bot.get_stranger_info(user_id=int(user_id))
         except ActionFailed as e:
             logger.warning(f"Error calling get_stranger_info failed: {e}")
+    return info or None
+
+
+async def get_user_info(bot: HoshinoBot, event: CQEvent, user_id: Union[str, int]) -> Optional[UserInfo]:
+    user_id = str(user_id)
+    if not check_qq_number(user_id):
+        return None
+    group_id = getattr(event, "group_id", None)
+    key = (group_id, user_id)
+    cached = user_info_cache.get(key)
+    if cached is None or cached[1] <= time.time():
+        member = True
+        if memes_user_info_bulk_load and group_id:
+            members = await load_group(bot, group_id)
+            cached = user_info_cache.get(key)
+            # 不在成员列表中的一定不是群成员，直接查陌生人信息；
+            # 在列表中但缓存已被淘汰的仍查询群成员信息，保留群名片
+            if members is not None:
+                member = user_id in members
+        if cached is None or cached[1] <= time.time():
+            info = await _fetch_info(bot, group_id, user_id, member)
+            ttl = memes_user_info_ttl if info else memes_user_info_negative_ttl
+            cached = (info, time.time() + ttl)
+            user_info_cache.set(key, cached)
+    info = cached[0]
 
     if info:
         qq = info["user_id"]
@@ -67,3 +132,12 @@ async def get_user_info(bot: HoshinoBot, event: CQEvent, user_id: Union[str, int
         user_name="",
         user_avatar=QQAvatar(qq=int(user_id)),
     )
+
+
+async def get_user_infos(
+    bot: HoshinoBot, event: CQEvent, user_ids: Iterable[Union[str, int]]
+) -> Dict[str, Optional[UserInfo]]:
+    """并发查询多个用户的信息，重复的 qq 只查询一次"""
+    user_ids = list(dict.fromkeys(str(user_id) for user_id in user_ids))
+    infos = await asyncio.gather(*(get_user_info(bot, event, user_id) for user_id in user_ids))
+    return dict(zip(user_ids, infos))
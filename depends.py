@@ -1,8 +1,7 @@
 import copy
 import re
-from typing import List, Dict, Any
+from typing import List, Dict, Any, Optional, Match, Union
 
-from aiohttp import ClientSession
 from meme_generator.meme import Meme
 
 from hoshino import HoshinoBot
@@ -16,24 +15,24 @@ from .data_source import (
     ImageSource,
     UserInfo,
     check_qq_number,
-    get_content,
     get_user_info,
+    get_user_infos,
 )
-from .utils import split_text
+from .data_source.image_cache import image_cache
+from .utils import get_msg, split_text
 
 
 class AlcImage(ImageSource):
     url: str = ""
 
+    def get_url(self) -> str:
+        if not self.url:
+            raise NotImplementedError
+        return self.url
+
     async def get_image(self) -> bytes:
         if self.url:
-            async with ClientSession() as session:
-                result = await get_content(self.url, session)
-            await session.close()
-        else:
-            raise NotImplementedError("image fetch not implemented")
-        if isinstance(result, bytes):
-            return result
+            return await image_cache.fetch(self.url)
         raise NotImplementedError("image fetch not implemented")
 
 
@@ -59,7 +58,7 @@ def restore_last_at_me_seg(event: CQEvent, msg: Message):
 
 async def split_msg_v11(
         bot: HoshinoBot, event: CQEvent, msg: Message,
-        meme: Meme, trigger: MessageSegment, is_regex: bool, is_random: bool
+        meme: Meme, trigger: MessageSegment, match: Optional[Match[str]], is_random: bool
 ) -> dict:
     texts: List[str] = []
     user_infos: List[UserInfo] = []
@@ -67,18 +66,13 @@ async def split_msg_v11(
     trigger_text_with_trigger: str = trigger.data["text"].strip()
     trigger_text_seg = Message()
     if not is_random:
-        if is_regex:
-            regex_args = []
-            raw_args = ""
-            for shortcut in meme.shortcuts:
-                raw_text = trigger_text_with_trigger.replace(meme_command_start, "")
-                regex_args = re.findall(shortcut.key, raw_text)
-                if regex_args:
-                    regex_args = regex_args[0]
-                    break
-            for each_arg in regex_args:
-                raw_args += f"{each_arg} "
-            trigger_text_seg = Message(f"{raw_args.strip()} ")
+        if match:
+            raw_text = trigger_text_with_trigger.replace(meme_command_start, "")
+            # 触发时可能只匹配了首个词，参数以完整文本为准
+            if match.string != raw_text:
+                match = match.re.search(raw_text) or match
+            raw_args = " ".join(arg for arg in match.groups() if arg)
+            trigger_text_seg = Message(f"{raw_args} ")
         else:
             for keyword in meme.keywords:
                 if re.search(rf"^{meme_command_start}{keyword}", trigger_text_with_trigger):
@@ -92,33 +86,29 @@ async def split_msg_v11(
 
     restore_last_at_me_seg(event, msg)
 
+    # 先按顺序记下图片和需要查询的用户，再并发查询所有用户信息
+    slots: List[Union[str, ImageSource]] = []
     for msg_seg in msg:
         if msg_seg.type == "at":
-            if user_info := await get_user_info(bot, event, msg_seg.data["qq"]):
-                if image_source := user_info.user_avatar:
-                    image_sources.append(image_source)
-                user_infos.append(user_info)
+            slots.append(str(msg_seg.data["qq"]))
 
         elif msg_seg.type == "image":
-            image_sources.append(
+            slots.append(
                 AlcImage(url=msg_seg.data["url"])
             )
 
         elif msg_seg.type == "reply":
             msg_id = msg_seg.data["id"]
-            source_msg = await bot.get_msg(message_id=int(msg_id))
+            source_msg = await get_msg(bot, event, int(msg_id))
             source_qq = str(source_msg['sender']['user_id'])
             source_msg = source_msg["message"]
             msgs = Message(source_msg)
             for each_msg in msgs:
                 if each_msg.type == "image":
-                    image_sources.append(AlcImage(url=each_msg.data["url"]))
+                    slots.append(AlcImage(url=each_msg.data["url"]))
                     break
             else:
-                if user_info := await get_user_info(bot, event, source_qq):
-                    if image_source := user_info.user_avatar:
-                        image_sources.append(image_source)
-                    user_infos.append(user_info)
+                slots.append(source_qq)
 
         elif msg_seg.type == "text":
             raw_text = msg_seg.data["text"].strip()
@@ -127,20 +117,31 @@ async def split_msg_v11(
                 text = text.strip()
                 user_id = text[1:]
                 if text.startswith("@") and check_qq_number(user_id):
-                    if user_info := await get_user_info(bot, event, user_id):
-                        if image_source := user_info.user_avatar:
-                            image_sources.append(image_source)
-                        user_infos.append(user_info)
+                    slots.append(user_id)
 
                 elif text == "自己":
-                    if user_info := await get_user_info(bot, event, event.user_id):
-                        if image_source := user_info.user_avatar:
-                            image_sources.append(image_source)
-                        user_infos.append(user_info)
+                    slots.append(str(event.user_id))
 
                 elif text:
                     texts.append(text)
 
+    user_ids = [slot for slot in slots if isinstance(slot, str)]
+    # 下面可能会用到发送者的头像，一并查询
+    if (meme.params_type.min_images == 2 and len(slots) == 1) or (
+            memes_use_sender_when_no_image
+            and meme.params_type.min_images == 1
+            and not slots
+    ):
+        user_ids.append(str(event.user_id))
+    users = await get_user_infos(bot, event, user_ids)
+    for slot in slots:
+        if not isinstance(slot, str):
+            image_sources.append(slot)
+        elif user_info := users.get(slot):
+            if image_source := user_info.user_avatar:
+                image_sources.append(image_source)
+            user_infos.append(user_info)
+
     args: Dict[str, Any] = {}
     if meme.params_type.args_type:
         raw_text_copy: List[str] = copy.deepcopy(texts)
@@ -1,7 +1,32 @@
-class NetworkError(Exception):
-    pass
+import asyncio
+from typing import Any, Optional
+
+from meme_generator.exception import MemeGeneratorException
+
+from .data_source.exception import DownloadRejectedError as DownloadRejectedError
+from .data_source.exception import NetworkError as NetworkError
 
 
 class PlatformUnsupportError(Exception):
     def __init__(self, platform: str):
         self.platform = platform
+
+
+class RenderError(MemeGeneratorException):
+    """子进程中制作表情出错，只保留错误信息"""
+
+    def __init__(self, message: str):
+        super().__init__(message)
+
+
+class RenderBusyError(Exception):
+    """制作队列已满或排队超时"""
+
+
+class RenderTimeoutError(Exception):
+    def __init__(self, key: str, timeout: float):
+        super().__init__(f"表情 {key} 制作超过 {timeout:g} 秒")
+        self.key = key
+        self.timeout = timeout
+        # 超时后仍在运行的制作（线程池中无法中止），结束前继续占用制作队列的名额
+        self.pending: "Optional[asyncio.Future[Any]]" = None
@@ -1,36 +1,44 @@
 import re
+import time
 from enum import IntEnum
-from typing import Any, Dict, Tuple, Union, List
+from typing import Any, Dict, Tuple, List, Optional, Match, Pattern
 
-from yaml import CLoader, dump, load, safe_load, unsafe_load
-from yaml.constructor import ConstructorError
-from meme_generator.manager import get_memes
+from meme_generator.config import meme_config
 from meme_generator.meme import Meme
-from pydantic import BaseModel
+from nonebot import on_startup
 
 import hoshino
-from .config import meme_disabled_list
+from hoshino.aiorequests import run_sync_func
+from .config import (
+    meme_disabled_list,
+    memes_config_changed,
+    memes_permission_backend,
+    memes_permission_commit_delay,
+    memes_permission_yaml_export,
+    memes_warm_up_on_startup,
+)
 import os
 
-from .data_source.compat import PYDANTIC_V2
+from .permission import MemeMode, PermissionIndex, Principal
+from .registry import meme_registry
+from .snapshot import load_snapshot, memes_hash, save_snapshot
+from .storage import PermissionStore, SqlitePermissionStore, YamlPermissionStore
 
 from pathlib import Path
 
 config_file_path = Path(os.path.join(os.path.dirname(__file__), "config.yml"))
+database_path = Path(os.path.join(os.path.dirname(__file__), "config.db"))
 
 
-class MemeMode(IntEnum):
-    BLACK = 0
-    WHITE = 1
-
-
-class MemeConfig(BaseModel):
-    mode: int = MemeMode.BLACK.value
-    white_list: List[str] = []
-    black_list: List[str] = []
-
-    class Config:
-        use_enum_values = True
+def create_store(path: Path = config_file_path) -> PermissionStore:
+    if memes_permission_backend == "yaml":
+        return YamlPermissionStore(path, delay=memes_permission_commit_delay)
+    return SqlitePermissionStore(
+        database_path,
+        yaml_path=path,
+        yaml_export=memes_permission_yaml_export,
+        delay=memes_permission_commit_delay,
+    )
 
 
 class ActionResult(IntEnum):
@@ -39,20 +47,80 @@ class ActionResult(IntEnum):
     NOTFOUND = 2
 
 
+def _strip_named_groups(pattern: str) -> str:
+    # 合并正则时各快捷指令的命名组可能重名，统一改为非捕获组
+    return re.sub(r"\(\?P<\w+>", "(?:", pattern)
+
+
 class MemeManager:
-    def __init__(self, path: Path = config_file_path):
-        self.__path = path
-        self.__meme_list: Dict[str, MemeConfig] = {}
+    def __init__(self, path: Path = config_file_path, store: Optional[PermissionStore] = None):
+        start = time.perf_counter()
+        self.__store = store or create_store(path)
+        self.__permissions = PermissionIndex([])
+        self.__names: Dict[str, Meme] = {}
+        self.__shortcuts: List[Tuple[Meme, Pattern[str]]] = []
+        self.__shortcut_regex: Optional[Pattern[str]] = None
+        self.version = 0
         self.memes = list(
             filter(
                 lambda meme: meme.key not in meme_disabled_list,
-                sorted(get_memes(), key=lambda meme: meme.key),
+                sorted(meme_registry.memes(), key=lambda meme: meme.key),
             )
         )
-        self.__load()
-        self.__dump()
+        memes_loaded = time.perf_counter()
+        self.__snapshot_hit = self.__load()
+        end = time.perf_counter()
+        hoshino.logger.info(
+            f"表情管理器初始化完成，共 {len(self.memes)} 个表情，耗时 {(end - start) * 1000:.1f}ms"
+            f"（加载表情 {(memes_loaded - start) * 1000:.1f}ms，"
+            f"读取表情开关 {(end - memes_loaded) * 1000:.1f}ms"
+            f"{'，使用启动快照' if self.__snapshot_hit else ''}）"
+        )
 
-    def block(self, user_id: str, meme_names=None) -> Dict[str, ActionResult]:
+    @property
+    def memes(self) -> List[Meme]:
+        return self.__memes
+
+    @memes.setter
+    def memes(self, memes: List[Meme]):
+        self.__memes = memes
+        self.version += 1
+        self.__build_index()
+
+    def __build_index(self):
+        names: Dict[str, Meme] = {}
+        shortcuts: List[Tuple[Meme, Pattern[str]]] = []
+        for meme in self.__memes:
+            for name in [meme.key, *sorted(meme.keywords, reverse=True)]:
+                names.setdefault(name.lower(), meme)
+            for shortcut in meme.shortcuts:
+                try:
+                    pattern = re.compile(shortcut.key, re.IGNORECASE)
+                except re.error as e:
+                    hoshino.logger.warning(f"表情 {meme.key} 的快捷指令 {shortcut.key} 无效: {e}")
+                    continue
+                shortcuts.append((meme, pattern))
+
+        # 每个快捷指令包在前瞻里，从开头匹配时按顺序尝试，与逐个 re.search 的优先级一致
+        shortcut_regex = None
+        if shortcuts:
+            try:
+                shortcut_regex = re.compile(
+                    "|".join(
+                        rf"(?=[\s\S]*?(?P<_s{i}>{_strip_named_groups(pattern.pattern)}))"
+                        for i, (_, pattern) in enumerate(shortcuts)
+                    ),
+                    re.IGNORECASE,
+                )
+            except re.error as e:
+                hoshino.logger.warning(f"快捷指令合并失败，将逐个匹配: {e}")
+
+        self.__names = names
+        self.__shortcuts = shortcuts
+        self.__shortcut_regex = shortcut_regex
+        self.__permissions.set_keys(meme.key for meme in self.__memes)
+
+    def block(self, principal: Principal, meme_names=None) -> Dict[str, ActionResult]:
         if meme_names is None:
             meme_names = []
         results = {}
@@ -61,16 +129,12 @@ class MemeManager:
             if not meme:
                 results[name] = ActionResult.NOTFOUND
                 continue
-            config = self.__meme_list[meme.key]
-            if user_id not in config.black_list:
-                config.black_list.append(user_id)
-            if user_id in config.white_list:
-                config.white_list.remove(user_id)
+            self.__permissions.set_rule(principal, meme.key, False)
+            self.__store.set_rule(principal, meme.key, False)
             results[name] = ActionResult.SUCCESS
-        self.__dump()
         return results
 
-    def unblock(self, user_id: str, meme_names=None) -> Dict[str, ActionResult]:
+    def unblock(self, principal: Principal, meme_names=None) -> Dict[str, ActionResult]:
         if meme_names is None:
             meme_names = []
         results = {}
@@ -79,13 +143,9 @@ class MemeManager:
             if not meme:
                 results[name] = ActionResult.NOTFOUND
                 continue
-            config = self.__meme_list[meme.key]
-            if user_id not in config.white_list:
-                config.white_list.append(user_id)
-            if user_id in config.black_list:
-                config.black_list.remove(user_id)
+            self.__permissions.set_rule(principal, meme.key, True)
+            self.__store.set_rule(principal, meme.key, True)
             results[name] = ActionResult.SUCCESS
-        self.__dump()
         return results
 
     def change_mode(self, mode: int, meme_names=None) -> Dict[str, ActionResult]:
@@ -97,88 +157,79 @@ class MemeManager:
             if not meme:
                 results[name] = ActionResult.NOTFOUND
                 continue
-            config = self.__meme_list[meme.key]
-            config.mode = mode
+            self.__permissions.set_mode(meme.key, mode)
+            self.__store.set_mode(meme.key, mode)
             results[name] = ActionResult.SUCCESS
-        self.__dump()
         return results
 
-    def find(self, meme_name: str) -> Tuple[Union[Meme, None], bool]:
-        for meme in self.memes:
-            if meme_name.lower() == meme.key.lower():
-                return meme, False
-            for keyword in sorted(meme.keywords, reverse=True):
-                if meme_name.lower() == keyword.lower():
-                    return meme, False
-            if meme.shortcuts:
-                for shortcut in meme.shortcuts:
-                    if re.search(shortcut.key, meme_name, re.IGNORECASE):
-                        return meme, True
-        return None, False
-
-    def check(self, user_id: str, meme_key: str) -> bool:
-        if meme_key not in self.__meme_list:
-            return False
-        config = self.__meme_list[meme_key]
-        if config.mode == MemeMode.BLACK.value:
-            if user_id in config.black_list:
-                return False
-            return True
-        elif config.mode == MemeMode.WHITE.value:
-            if user_id in config.white_list:
-                return True
-            return False
-        return False
-
-    def __load(self):
-        raw_list: Dict[str, Any] = {}
-        if self.__path.exists():
-            try:
-                with self.__path.open("r", encoding="utf-8") as f:
-                    content = f.read()
-                    try:
-                        raw_list = safe_load(content)
-                    except ConstructorError as e:
-                        hoshino.logger.warning(f"无法使用 safe_load: {e}")
-                        try:
-                            hoshino.logger.warning("尝试使用 CLoader")
-                            raw_list = load(content, Loader=CLoader)
-                        except ConstructorError as e:
-                            hoshino.logger.warning(f"无法使用 CLoader: {e}")
-                            raw_list = unsafe_load(content)
-            except UnicodeDecodeError:
-                hoshino.logger.warning("表情列表解析失败（编码错误），将重新生成")
-            except Exception as e:
-                hoshino.logger.warning(f"表情列表读取失败: {e}，将重新生成")
-
+    def find(self, meme_name: str) -> Tuple[Optional[Meme], Optional[Match[str]]]:
+        if meme := self.__names.get(meme_name.lower()):
+            return meme, None
+        if self.__shortcut_regex is not None:
+            combined = self.__shortcut_regex.match(meme_name)
+            if combined and combined.lastgroup:
+                meme, pattern = self.__shortcuts[int(combined.lastgroup[2:])]
+                return meme, pattern.search(meme_name)
+            return None, None
+        for meme, pattern in self.__shortcuts:
+            if match := pattern.search(meme_name):
+                return meme, match
+        return None, None
+
+    def check(self, principal: Principal, meme_key: str) -> bool:
+        return self.__permissions.check(principal, meme_key)
+
+    def enabled(self, principal: Principal) -> int:
+        # 可用表情位图，第 i 位对应 self.memes[i]
+        return self.__permissions.enabled(principal)
+
+    def __snapshot_key(self) -> Tuple[Any, ...]:
+        return memes_permission_backend, self.__store.fingerprint(), memes_hash(self.memes)
+
+    def __load(self) -> bool:
+        snapshot = load_snapshot(self.__snapshot_key())
+        if snapshot is not None:
+            modes = snapshot["modes"]
+            rules = [
+                (Principal(bot_id, group_id, user_id), key, enabled)
+                for bot_id, group_id, user_id, key, enabled in snapshot["rules"]
+            ]
+            self.__store.seed(modes, rules)
+        else:
+            modes, rules = self.__store.load()
+        for key, mode in modes.items():
+            self.__permissions.set_mode(key, mode)
+        for principal, key, enabled in rules:
+            self.__permissions.set_rule(principal, key, enabled)
+        return snapshot is not None
+
+    async def prepare(self):
+        # 启动完成后再做建库、写快照等写盘操作，不拖慢插件导入
+        await run_sync_func(self.__store.prepare)
+        if self.__snapshot_hit:
+            return
+        data = {
+            "modes": dict(self.__permissions.modes),
+            "rules": [
+                (*principal, key, enabled)
+                for principal, key, enabled in self.__permissions.rules()
+            ],
+        }
         try:
-            meme_list = {
-                name: MemeConfig.model_validate(config)
-                for name, config in raw_list.items()
-            }
-        except AttributeError:
-            meme_list = {}
-            hoshino.logger.warning("表情列表解析失败，将重新生成")
-
-        self.__meme_list = {meme.key: MemeConfig() for meme in self.memes}
-        self.__meme_list.update(meme_list)
-
-    def __dump(self):
-        self.__path.parent.mkdir(parents=True, exist_ok=True)
-        meme_list = {}
+            await run_sync_func(save_snapshot, self.__snapshot_key(), data)
+            self.__snapshot_hit = True
+        except Exception as e:
+            hoshino.logger.warning(f"表情快照保存失败: {e}")
 
-        for name, config in self.__meme_list.items():
-            if PYDANTIC_V2:
-                config_dict = config.model_dump()
-            else:
-                config_dict = config.dict()
 
-            if isinstance(config_dict['mode'], MemeMode):
-                config_dict['mode'] = config_dict['mode'].value
-
-            meme_list[name] = config_dict
+meme_manager = MemeManager()
 
-        with self.__path.open("w", encoding="utf-8") as f:
-            dump(meme_list, f, allow_unicode=True)
 
-meme_manager = MemeManager()
+@on_startup
+async def _():
+    if memes_config_changed:
+        await run_sync_func(meme_config.dump)
+    await run_sync_func(meme_registry.save)
+    await meme_manager.prepare()
+    if memes_warm_up_on_startup:
+        await run_sync_func(meme_registry.warm_up)
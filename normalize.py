@@ -0,0 +1,150 @@
+import math
+from io import BytesIO
+from typing import List, Tuple
+
+from meme_generator.exception import OpenImageFailed
+from PIL import Image, ImageOps, ImageSequence
+
+from .config import (
+    memes_image_max_duration,
+    memes_image_max_fps,
+    memes_image_max_frames,
+    memes_image_max_size,
+    memes_image_max_sizes,
+)
+
+ORIENTATION = 0x0112
+# 浏览器和 QQ 都把不超过 10ms 的帧间隔当作 100ms 播放
+DEFAULT_FRAME_DURATION = 100
+
+
+def max_image_size(key: str) -> int:
+    return memes_image_max_sizes.get(key, memes_image_max_size)
+
+
+def normalize_options(key: str) -> Tuple[float, ...]:
+    """影响输入图片处理结果的设置，需要计入制作结果的缓存键"""
+    return (max_image_size(key), memes_image_max_frames, memes_image_max_duration, memes_image_max_fps)
+
+
+def frame_durations(img: Image.Image) -> List[int]:
+    durations = []
+    for frame in ImageSequence.Iterator(img):
+        duration = frame.info.get("duration") or 0
+        durations.append(duration if duration > 10 else DEFAULT_FRAME_DURATION)
+    img.seek(0)
+    return durations
+
+
+def select_frames(
+    durations: List[int],
+    max_frames: int = memes_image_max_frames,
+    max_duration: float = memes_image_max_duration,
+    max_fps: float = memes_image_max_fps,
+) -> Tuple[List[int], List[int]]:
+    """按上限挑选动图的帧，返回帧序号和新的帧间隔（毫秒）
+
+    超过 `max_duration` 秒的部分直接截掉；帧数超过 `max_frames` 或帧率超过 `max_fps` 时
+    按时间均匀抽帧，抽帧后的帧间隔相同，总时长不变（表情一般只读取第一帧的间隔）。
+    """
+    if max_duration:
+        total = 0
+        for count, duration in enumerate(durations):
+            if total >= max_duration * 1000:
+                durations = durations[:count]
+                break
+            total += duration
+    total = sum(durations)
+
+    limit = len(durations)
+    if max_frames:
+        limit = min(limit, max_frames)
+    if max_fps:
+        limit = min(limit, max(int(total / 1000 * max_fps), 1))
+    if limit >= len(durations):
+        return list(range(len(durations))), durations
+
+    starts = [0]
+    for duration in durations[:-1]:
+        starts.append(starts[-1] + duration)
+    indexes = []
+    frame = 0
+    for i in range(limit):
+        time = total * i / limit
+        while frame + 1 < len(starts) and starts[frame + 1] <= time:
+            frame += 1
+        indexes.append(frame)
+    return indexes, [round(total / limit)] * limit
+
+
+def _normalize_animated(img: Image.Image, data: bytes, max_size: int) -> bytes:
+    durations = frame_durations(img)
+    indexes, durations = select_frames(durations)
+    oversize = max_size and max(img.size) > max_size
+    if not oversize and len(indexes) == img.n_frames:
+        return data
+
+    frames: List[Image.Image] = []
+    for index in indexes:
+        img.seek(index)
+        frame = img.convert("RGBA")
+        if oversize:
+            frame.thumbnail((max_size, max_size), Image.LANCZOS)
+        frames.append(frame)
+
+    output = BytesIO()
+    frames[0].save(
+        output,
+        format="GIF",
+        save_all=True,
+        append_images=frames[1:],
+        duration=durations,
+        loop=img.info.get("loop", 0),
+        disposal=2,
+    )
+    return output.getvalue()
+
+
+def _normalize_static(img: Image.Image, data: bytes, max_size: int) -> bytes:
+    orientation = img.getexif().get(ORIENTATION, 1)
+    width, height = img.size
+    oversize = max_size and max(width, height) > max_size
+    if not oversize and orientation == 1:
+        return data
+
+    fmt = img.format
+    if oversize and fmt == "JPEG":
+        scale = max_size / max(width, height)
+        img.draft(img.mode, (math.ceil(width * scale), math.ceil(height * scale)))
+    img = ImageOps.exif_transpose(img)
+    if max_size and max(img.size) > max_size:
+        img.thumbnail((max_size, max_size), Image.LANCZOS)
+
+    output = BytesIO()
+    if fmt == "JPEG" and img.mode in ("RGB", "L", "CMYK"):
+        img.save(output, format="JPEG", quality=95)
+    else:
+        img.save(output, format="PNG")
+    return output.getvalue()
+
+
+def normalize_image(data: bytes, max_size: int) -> bytes:
+    """缩小过大的输入图片，没有变化时原样返回
+
+    静态图片按 EXIF 方向转正，JPEG 在解码时就用 `draft` 按 1/2、1/4、1/8 缩小，
+    之后只再缩放一次，重新编码时不保留 EXIF。动图按帧数、时长和帧率上限抽帧，
+    结果统一保存为 GIF。无法识别或解码出错（如不完整）的图片抛出 `OpenImageFailed`，
+    与表情自己加载图片失败时一样回复。
+    """
+    try:
+        img = Image.open(BytesIO(data))
+        if getattr(img, "is_animated", False):
+            return _normalize_animated(img, data, max_size)
+        return _normalize_static(img, data, max_size)
+    except Exception as e:
+        raise OpenImageFailed(str(e)) from None
+
+
+def normalize_images(key: str, images: List[bytes]) -> List[bytes]:
+    max_size = max_image_size(key)
+    return [normalize_image(image, max_size) for image in images]
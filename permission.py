@@ -0,0 +1,119 @@
+from enum import IntEnum
+from typing import Dict, Iterable, Iterator, List, NamedTuple, Optional, Tuple
+
+
+class MemeMode(IntEnum):
+    BLACK = 0
+    WHITE = 1
+
+
+class Principal(NamedTuple):
+    bot_id: str
+    group_id: str
+    user_id: Optional[str] = None
+
+    @classmethod
+    def parse(cls, uid: str) -> Optional["Principal"]:
+        # 兼容旧配置中 `self_group_user` / `self_group` 格式的字符串 id
+        parts = str(uid).split("_")
+        if len(parts) == 3:
+            return cls(*parts)
+        if len(parts) == 2:
+            return cls(parts[0], parts[1])
+        return None
+
+    @property
+    def group(self) -> "Principal":
+        return Principal(self.bot_id, self.group_id)
+
+    def __str__(self) -> str:
+        if self.user_id is None:
+            return f"{self.bot_id}_{self.group_id}"
+        return f"{self.bot_id}_{self.group_id}_{self.user_id}"
+
+
+class PermissionIndex:
+    """按 bot、群、用户分层的表情开关索引
+
+    每个群可以有群级别的默认规则（user_id 为 None），用户规则覆盖群规则，
+    群规则覆盖表情本身的黑/白名单模式。每个主体可用的表情以位图缓存。
+    """
+
+    def __init__(self, keys: Iterable[str]):
+        self.__bits: Dict[str, int] = {}
+        self.__modes: Dict[str, int] = {}
+        # (bot_id, group_id) -> user_id（None 为群规则）-> 表情 key -> 是否启用
+        self.__rules: Dict[Tuple[str, str], Dict[Optional[str], Dict[str, bool]]] = {}
+        self.__default = 0
+        self.__cache: Dict[Tuple[str, str], Dict[Optional[str], int]] = {}
+        self.set_keys(keys)
+
+    def set_keys(self, keys: Iterable[str]):
+        self.__bits = {key: 1 << i for i, key in enumerate(keys)}
+        self.__rebuild_default()
+
+    def __rebuild_default(self):
+        self.__default = 0
+        for key, bit in self.__bits.items():
+            if self.__modes.get(key, MemeMode.BLACK.value) == MemeMode.BLACK.value:
+                self.__default |= bit
+        self.__cache.clear()
+
+    @property
+    def modes(self) -> Dict[str, int]:
+        return self.__modes
+
+    def get_mode(self, key: str) -> int:
+        return self.__modes.get(key, MemeMode.BLACK.value)
+
+    def set_mode(self, key: str, mode: int):
+        self.__modes[key] = int(mode)
+        bit = self.__bits.get(key, 0)
+        if mode == MemeMode.BLACK.value:
+            self.__default |= bit
+        else:
+            self.__default &= ~bit
+        self.__cache.clear()
+
+    def set_rule(self, principal: Principal, key: str, enabled: Optional[bool]):
+        group = (principal.bot_id, principal.group_id)
+        if enabled is None:
+            users = self.__rules.get(group, {})
+            users.get(principal.user_id, {}).pop(key, None)
+        else:
+            users = self.__rules.setdefault(group, {})
+            users.setdefault(principal.user_id, {})[key] = enabled
+        self.__cache.pop(group, None)
+
+    def get_rule(self, principal: Principal, key: str) -> Optional[bool]:
+        users = self.__rules.get((principal.bot_id, principal.group_id), {})
+        return users.get(principal.user_id, {}).get(key)
+
+    def rules(self) -> Iterator[Tuple[Principal, str, bool]]:
+        for (bot_id, group_id), users in self.__rules.items():
+            for user_id, rules in users.items():
+                for key, enabled in rules.items():
+                    yield Principal(bot_id, group_id, user_id), key, enabled
+
+    def enabled(self, principal: Principal) -> int:
+        group = (principal.bot_id, principal.group_id)
+        cache = self.__cache.get(group)
+        if cache is not None and principal.user_id in cache:
+            return cache[principal.user_id]
+
+        mask = self.__default
+        users = self.__rules.get(group)
+        if users:
+            levels: List[Optional[str]] = [None]
+            if principal.user_id is not None:
+                levels.append(principal.user_id)
+            for level in levels:
+                for key, enabled in users.get(level, {}).items():
+                    bit = self.__bits.get(key, 0)
+                    mask = mask | bit if enabled else mask & ~bit
+
+        self.__cache.setdefault(group, {})[principal.user_id] = mask
+        return mask
+
+    def check(self, principal: Principal, key: str) -> bool:
+        return bool(self.enabled(principal) & self.__bits.get(key, 0))
@@ -0,0 +1,130 @@
+import math
+import time
+from typing import Dict, Hashable, Optional, Tuple
+
+from meme_generator.meme import Meme
+
+from .config import (
+    memes_rate_limit_costs,
+    memes_rate_limit_group_capacity,
+    memes_rate_limit_group_rate,
+    memes_rate_limit_user_capacity,
+    memes_rate_limit_user_rate,
+)
+from .permission import Principal
+
+
+class TokenBucket:
+    """按键区分的令牌桶
+
+    只保存 (剩余令牌, 上次更新时间)，已经回满的桶与不存在等价，定期清理以控制内存。
+    """
+
+    def __init__(self, capacity: float, rate: float, purge_interval: float = 60):
+        self.capacity = capacity
+        self.rate = rate
+        self.purge_interval = purge_interval
+        self.__buckets: Dict[Hashable, Tuple[float, float]] = {}
+        self.__last_purge = time.monotonic()
+
+    def __len__(self) -> int:
+        return len(self.__buckets)
+
+    def tokens(self, key: Hashable, now: Optional[float] = None) -> float:
+        bucket = self.__buckets.get(key)
+        if bucket is None:
+            return self.capacity
+        now = time.monotonic() if now is None else now
+        tokens, last = bucket
+        return min(self.capacity, tokens + (now - last) * self.rate)
+
+    def wait_time(self, key: Hashable, cost: float, now: Optional[float] = None) -> float:
+        """还需等待多少秒才有足够的令牌，0 表示现在就可以"""
+        cost = min(cost, self.capacity)
+        tokens = self.tokens(key, now)
+        if tokens >= cost:
+            return 0
+        return (cost - tokens) / self.rate if self.rate > 0 else math.inf
+
+    def consume(self, key: Hashable, cost: float, now: Optional[float] = None):
+        now = time.monotonic() if now is None else now
+        tokens = self.tokens(key, now) - min(cost, self.capacity)
+        self.__buckets[key] = (tokens, now)
+        self.__purge(now)
+
+    def __purge(self, now: float):
+        if now - self.__last_purge < self.purge_interval:
+            return
+        self.__last_purge = now
+        full = [key for key in self.__buckets if self.tokens(key, now) >= self.capacity]
+        for key in full:
+            del self.__buckets[key]
+
+
+class RateLimiter:
+    """每个用户和每个群的表情制作频率限制，容量或恢复速率为 0 时不限制
+
+    被限制的用户在需要等待的时间内只提醒一次，避免刷屏的消息换来同样多的回复。
+    """
+
+    def __init__(
+        self,
+        user_capacity: float,
+        user_rate: float,
+        group_capacity: float,
+        group_rate: float,
+        costs: Dict[str, float],
+    ):
+        self.user = TokenBucket(user_capacity, user_rate) if user_capacity > 0 and user_rate > 0 else None
+        self.group = TokenBucket(group_capacity, group_rate) if group_capacity > 0 and group_rate > 0 else None
+        self.costs = costs
+        # 用户 -> 下次可以提醒的时间
+        self.__notified: Dict[Hashable, float] = {}
+        self.__last_purge = time.monotonic()
+
+    def cost(self, meme: Meme) -> float:
+        # 先按表情 key，再按表情标签（消耗最大的标签）确定消耗的令牌数
+        if meme.key in self.costs:
+            return self.costs[meme.key]
+        return max((self.costs[tag] for tag in meme.tags if tag in self.costs), default=1)
+
+    def check(self, principal: Principal, meme: Meme) -> float:
+        """令牌足够时扣除并返回 0，否则不扣除并返回需要等待的秒数"""
+        cost = self.cost(meme)
+        if cost <= 0:
+            return 0
+        now = time.monotonic()
+        user_key = (principal.bot_id, principal.group_id, principal.user_id)
+        group_key = (principal.bot_id, principal.group_id)
+        wait = max(
+            self.user.wait_time(user_key, cost, now) if self.user is not None else 0,
+            self.group.wait_time(group_key, cost, now) if self.group is not None else 0,
+        )
+        if wait:
+            return wait
+        if self.user is not None:
+            self.user.consume(user_key, cost, now)
+        if self.group is not None:
+            self.group.consume(group_key, cost, now)
+        return 0
+
+    def notify(self, principal: Principal, wait: float) -> bool:
+        """被限制时是否需要提醒，同一用户在 `wait` 秒内只提醒一次"""
+        now = time.monotonic()
+        if now - self.__last_purge >= 60:
+            self.__last_purge = now
+            self.__notified = {key: until for key, until in self.__notified.items() if until > now}
+        key = (principal.bot_id, principal.group_id, principal.user_id)
+        if self.__notified.get(key, 0) > now:
+            return False
+        self.__notified[key] = now + wait
+        return True
+
+
+rate_limiter = RateLimiter(
+    memes_rate_limit_user_capacity,
+    memes_rate_limit_user_rate,
+    memes_rate_limit_group_capacity,
+    memes_rate_limit_group_rate,
+    memes_rate_limit_costs,
+)
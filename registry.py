@@ -0,0 +1,210 @@
+import importlib.util
+import os
+import pkgutil
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Set, Tuple
+
+from meme_generator.manager import get_meme, get_meme_keys, get_memes
+from meme_generator.meme import CommandShortcut, Meme, MemeArgsType
+
+import hoshino
+from .config import meme_dirs, meme_loaded_dirs, memes_lazy_load
+from .snapshot import file_fingerprint, load_snapshot, save_snapshot
+
+registry_path = Path(os.path.join(os.path.dirname(__file__), "memes_cache_dir", "registry.pickle"))
+
+ModuleId = Tuple[str, str]
+
+
+class LazyParamsType:
+    """与 `MemeParamsType` 字段一致，只有读取 `args_type` 时才导入表情模块"""
+
+    def __init__(
+        self,
+        registry: "MemeRegistry",
+        key: str,
+        min_images: int = 0,
+        max_images: int = 0,
+        min_texts: int = 0,
+        max_texts: int = 0,
+        default_texts: Optional[List[str]] = None,
+    ):
+        self.__registry = registry
+        self.__key = key
+        self.min_images = min_images
+        self.max_images = max_images
+        self.min_texts = min_texts
+        self.max_texts = max_texts
+        self.default_texts = default_texts or []
+
+    @property
+    def args_type(self) -> Optional[MemeArgsType]:
+        return self.__registry.load(self.__key).params_type.args_type
+
+
+def _meme_meta(meme: Meme) -> Dict[str, Any]:
+    params = meme.params_type
+    return {
+        "key": meme.key,
+        "keywords": list(meme.keywords),
+        "shortcuts": [
+            {"key": shortcut.key, "args": shortcut.args, "humanized": shortcut.humanized}
+            for shortcut in meme.shortcuts
+        ],
+        "tags": list(meme.tags),
+        "min_images": params.min_images,
+        "max_images": params.max_images,
+        "min_texts": params.min_texts,
+        "max_texts": params.max_texts,
+        "default_texts": list(params.default_texts),
+        "date_created": meme.date_created,
+        "date_modified": meme.date_modified,
+    }
+
+
+class MemeRegistry:
+    """插件表情目录的注册表
+
+    只保存路由所需的元数据（key、关键词、快捷指令、图文数量），
+    表情模块在首次触发或预览时才导入。元数据缓存在 memes_cache_dir 中，
+    以模块文件的修改时间判断是否需要重新导入。
+    """
+
+    def __init__(self, dirs: List[str], lazy: bool = True):
+        self.__dirs = [meme_dir for meme_dir in dirs if meme_dir not in meme_loaded_dirs]
+        self.__lazy = lazy
+        self.__lock = threading.RLock()
+        self.__modules: Dict[str, ModuleId] = {}
+        self.__loaded: Set[ModuleId] = set()
+        self.__cache: Dict[str, Tuple[Any, List[Dict[str, Any]]]] = {}
+        self.__cache_dirty = False
+
+    def scan(self) -> List[Meme]:
+        """返回尚未导入的表情的占位对象；需要立即导入的模块会在这里导入"""
+        cache: Dict[str, Tuple[Any, List[Dict[str, Any]]]] = load_snapshot(("registry",), registry_path) or {}
+        self.__cache = {}
+        stubs: List[Meme] = []
+        for meme_dir in self.__dirs:
+            for module_info in pkgutil.iter_modules([meme_dir]):
+                if module_info.name.startswith("_"):
+                    continue
+                module_id = (meme_dir, module_info.name)
+                module_path = Path(meme_dir) / module_info.name
+                if module_info.ispkg:
+                    module_path = module_path / "__init__.py"
+                else:
+                    module_path = module_path.with_suffix(".py")
+                fingerprint = file_fingerprint(module_path)
+
+                entry = cache.get(os.path.join(*module_id))
+                if self.__lazy and entry and entry[0] == fingerprint:
+                    metas = entry[1]
+                else:
+                    metas = self.__import(module_id)
+                    self.__cache_dirty = True
+                self.__cache[os.path.join(*module_id)] = (fingerprint, metas)
+
+                for meta in metas:
+                    self.__modules[meta["key"]] = module_id
+                    if module_id not in self.__loaded:
+                        stubs.append(self.__stub(meta))
+        if len(self.__cache) != len(cache):
+            self.__cache_dirty = True
+        return stubs
+
+    def memes(self) -> List[Meme]:
+        """全部表情，尚未导入的用占位对象代替
+
+        `scan` 中导入的模块在 `scan` 之后才注册到 meme_generator，所以要在 `scan` 之后
+        再取已注册的表情；同一个 key 优先使用真正的表情。
+        """
+        memes = {meme.key: meme for meme in self.scan()}
+        memes.update((meme.key, meme) for meme in get_memes())
+        return list(memes.values())
+
+    def __stub(self, meta: Dict[str, Any]) -> Meme:
+        key = meta["key"]
+
+        def function(images, texts, args):
+            return self.load(key).function(images, texts, args)
+
+        return Meme(
+            key,
+            function,
+            LazyParamsType(
+                self,
+                key,
+                meta["min_images"],
+                meta["max_images"],
+                meta["min_texts"],
+                meta["max_texts"],
+                meta["default_texts"],
+            ),
+            keywords=meta["keywords"],
+            shortcuts=[CommandShortcut(**shortcut) for shortcut in meta["shortcuts"]],
+            tags=set(meta["tags"]),
+            date_created=meta.get("date_created") or datetime(2021, 5, 4),
+            date_modified=meta.get("date_modified") or datetime.now(),
+        )
+
+    def __import(self, module_id: ModuleId) -> List[Dict[str, Any]]:
+        with self.__lock:
+            meme_dir, name = module_id
+            before = set(get_meme_keys())
+            self.__loaded.add(module_id)
+            importer = pkgutil.get_importer(meme_dir)
+            spec = importer.find_spec(name) if importer else None
+            if not spec or not spec.loader:
+                hoshino.logger.warning(f"找不到表情模块 {name}")
+                return []
+            try:
+                module = importlib.util.module_from_spec(spec)
+                spec.loader.exec_module(module)
+            except Exception as e:
+                hoshino.logger.error(f"表情模块 {name} 导入失败: {e}")
+                return []
+            return [_meme_meta(get_meme(key)) for key in get_meme_keys() if key not in before]
+
+    def load(self, key: str) -> Meme:
+        module_id = self.__modules.get(key)
+        if module_id and module_id not in self.__loaded:
+            with self.__lock:
+                if module_id not in self.__loaded:
+                    start = time.perf_counter()
+                    self.__import(module_id)
+                    hoshino.logger.info(
+                        f"按需加载表情 {key}，耗时 {(time.perf_counter() - start) * 1000:.1f}ms"
+                    )
+        return get_meme(key)
+
+    def fingerprint(self, key: str) -> Any:
+        """表情所在模块文件的指纹，内置表情返回 None"""
+        module_id = self.__modules.get(key)
+        if not module_id:
+            return None
+        entry = self.__cache.get(os.path.join(*module_id))
+        return entry[0] if entry else None
+
+    def warm_up(self):
+        start = time.perf_counter()
+        pending = {module_id for module_id in self.__modules.values() if module_id not in self.__loaded}
+        for module_id in pending:
+            with self.__lock:
+                if module_id not in self.__loaded:
+                    self.__import(module_id)
+        if pending:
+            hoshino.logger.info(
+                f"预加载了 {len(pending)} 个表情模块，耗时 {(time.perf_counter() - start) * 1000:.1f}ms"
+            )
+
+    def save(self):
+        if not self.__cache_dirty:
+            return
+        save_snapshot(("registry",), self.__cache, registry_path)
+        self.__cache_dirty = False
+
+
+meme_registry = MemeRegistry(meme_dirs, lazy=memes_lazy_load)
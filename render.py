@@ -0,0 +1,460 @@
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
+import signal
+import time
+from collections import Counter, deque
+from contextlib import asynccontextmanager
+from multiprocessing.connection import Connection
+from multiprocessing.context import BaseContext
+from typing import Any, AsyncIterator, Callable, Deque, Dict, List, Optional, Set, Tuple
+
+from meme_generator.exception import MemeGeneratorException
+from meme_generator.version import __version__ as meme_generator_version
+from nonebot import get_bot, on_startup
+
+import hoshino
+from hoshino.aiorequests import run_sync_func
+from .cache import LRUCache, SingleFlight, disk_cache
+from .compress import fit_output
+from .config import (
+    memes_output_max_size,
+    memes_render_cache_disk,
+    memes_render_cache_exclude,
+    memes_render_cache_memory_size,
+    memes_render_concurrency,
+    memes_render_engine,
+    memes_render_group_concurrency,
+    memes_render_queue_size,
+    memes_render_queue_timeout,
+    memes_render_timeout,
+    memes_render_timeouts,
+    memes_render_workers,
+)
+from .exception import RenderBusyError, RenderError, RenderTimeoutError
+from .normalize import normalize_images, normalize_options
+from .registry import meme_registry
+
+
+def render_meme(key: str, images: List[bytes], texts: List[str], args: Dict[str, Any]) -> bytes:
+    """制作表情，只接收和返回可以跨进程传递的数据"""
+    meme = meme_registry.load(key)
+    images = normalize_images(key, images)
+    return fit_output(meme(images=images, texts=texts, args=args).getvalue())
+
+
+def _render_in_worker(key: str, images: List[bytes], texts: List[str], args: Dict[str, Any]) -> bytes:
+    try:
+        return render_meme(key, images, texts, args)
+    except MemeGeneratorException as e:
+        # 部分异常的构造参数与 message 不同，无法原样传回主进程
+        raise RenderError(e.message) from None
+
+
+WORKER_READY = "ready"
+# 子进程启动（预先导入全部表情）的时限，超时的子进程会被结束并重新创建
+WORKER_READY_TIMEOUT = 60
+
+
+def _init_worker():
+    # Ctrl+C 由主进程处理，子进程随主进程退出
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    meme_registry.warm_up()
+
+
+def _worker_main(conn: Connection):
+    _init_worker()
+    try:
+        conn.send(WORKER_READY)
+    except (EOFError, OSError):
+        return
+    while True:
+        try:
+            key, images, texts, args = conn.recv()
+        except (EOFError, OSError):
+            break
+        try:
+            result: Tuple[bool, Any] = (True, _render_in_worker(key, images, texts, args))
+        except Exception as e:
+            result = (False, e)
+        try:
+            conn.send(result)
+        except (EOFError, OSError):
+            break
+        except Exception:
+            # 异常无法序列化时只传回描述
+            conn.send((False, RuntimeError(repr(result[1]))))
+
+
+class RenderEngine:
+    """在线程池中制作表情
+
+    超出时限时只能放弃等待，线程仍会继续运行直到制作结束，在此之前一直占用制作队列的名额。
+    """
+
+    name = "thread"
+
+    def __init__(self, timeout: float = 0, timeouts: Optional[Dict[str, float]] = None):
+        self.timeout = timeout
+        self.timeouts = timeouts or {}
+        # 表情 key -> 超时次数
+        self.timeout_counts: Counter = Counter()
+
+    def budget(self, key: str) -> float:
+        return self.timeouts.get(key, self.timeout)
+
+    def _timed_out(self, key: str, budget: float) -> RenderTimeoutError:
+        self.timeout_counts[key] += 1
+        hoshino.logger.warning(f"表情 {key} 制作超过 {budget:g} 秒，已放弃")
+        return RenderTimeoutError(key, budget)
+
+    @staticmethod
+    def _discard(future: "asyncio.Future[Any]"):
+        if not future.cancelled():
+            future.exception()
+
+    async def start(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    async def render(self, key: str, images: List[bytes], texts: List[str], args: Dict[str, Any]) -> bytes:
+        budget = self.budget(key)
+        future = asyncio.ensure_future(run_sync_func(render_meme, key, images, texts, args))
+        try:
+            return await asyncio.wait_for(asyncio.shield(future), budget or None)
+        except asyncio.TimeoutError:
+            future.add_done_callback(self._discard)
+            error = self._timed_out(key, budget)
+            error.pending = future
+            raise error from None
+
+
+class Worker:
+    """一个制作子进程
+
+    管道读写在超过缓冲区大小时会阻塞，直到对方读取，因此都放在线程中进行。
+    """
+
+    def __init__(self, context: BaseContext):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn,), daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.__io: Optional["asyncio.Future[Any]"] = None
+
+    async def __run(self, func: Callable[..., Any], *args: Any) -> Any:
+        # 等待方被取消时线程仍在读写管道，要等它结束后才能关闭管道
+        self.__io = asyncio.ensure_future(run_sync_func(func, *args))
+        return await asyncio.shield(self.__io)
+
+    async def send(self, obj: Any):
+        await self.__run(self.conn.send, obj)
+
+    async def recv(self) -> Any:
+        return await self.__run(self.conn.recv)
+
+    async def call(self, job: Tuple[str, List[bytes], List[str], Dict[str, Any]]) -> Tuple[bool, Any]:
+        await self.send(job)
+        return await self.recv()
+
+    def __close(self, io: "asyncio.Future[Any]"):
+        if not io.cancelled():
+            io.exception()
+        self.conn.close()
+
+    def kill(self) -> "asyncio.Task[None]":
+        """结束子进程，返回等待其退出并关闭管道的任务"""
+        self.process.kill()
+        return asyncio.ensure_future(self.__reap())
+
+    async def __reap(self):
+        # 轮询子进程是否退出，不在事件循环中阻塞地 join
+        deadline = time.monotonic() + 1
+        while self.process.is_alive() and time.monotonic() < deadline:
+            await asyncio.sleep(0.01)
+        # 子进程退出后，线程中的读写会因管道关闭而结束
+        if self.__io is not None and not self.__io.done():
+            self.__io.add_done_callback(self.__close)
+        else:
+            self.conn.close()
+
+
+class ProcessRenderEngine(RenderEngine):
+    """在子进程中制作表情，多个 GIF 可以同时占用多个核心
+
+    子进程由 fork 创建，预先导入全部表情后通知主进程才开始接收任务；输入的图片和输出的结果
+    经管道以 bytes 传递，制作出错时抛出 `RenderError`（`MemeGeneratorException` 的子类）。
+    制作超出时限或启动超时（如 fork 时继承了被占用的锁）的子进程会被直接结束并重新创建，
+    不会一直占用制作能力。
+    """
+
+    name = "process"
+
+    def __init__(self, workers: int = 0, timeout: float = 0, timeouts: Optional[Dict[str, float]] = None):
+        super().__init__(timeout, timeouts)
+        self.workers = workers or os.cpu_count() or 1
+        self.__context = multiprocessing.get_context("fork")
+        self.__idle: Optional["asyncio.Queue[Worker]"] = None
+        self.__all: List[Worker] = []
+        self.__starting: Set["asyncio.Task[None]"] = set()
+        self.__reaping: Set["asyncio.Task[None]"] = set()
+        self.restarts = 0
+
+    def __spawn(self, delay: float = 0):
+        worker = Worker(self.__context)
+        self.__all.append(worker)
+        task = asyncio.ensure_future(self.__admit(worker, delay))
+        self.__starting.add(task)
+        task.add_done_callback(self.__starting.discard)
+
+    async def __admit(self, worker: Worker, delay: float):
+        """子进程准备好之后才放入空闲队列"""
+        if delay:
+            await asyncio.sleep(delay)
+        try:
+            ready = await asyncio.wait_for(worker.recv(), WORKER_READY_TIMEOUT)
+        except (asyncio.TimeoutError, EOFError, OSError):
+            ready = None
+        if ready != WORKER_READY:
+            hoshino.logger.error("表情制作子进程启动失败，已重新创建")
+            # 稍等再重新创建，避免子进程每次都启动失败时不停地 fork
+            self.__replace(worker, delay=1)
+            return
+        self.__idle.put_nowait(worker)
+
+    def __replace(self, worker: Worker, delay: float = 0):
+        task = worker.kill()
+        self.__reaping.add(task)
+        task.add_done_callback(self.__reaping.discard)
+        self.__all.remove(worker)
+        self.restarts += 1
+        self.__spawn(delay)
+
+    async def start(self):
+        start = time.perf_counter()
+        self.__idle = asyncio.Queue()
+        for _ in range(self.workers):
+            self.__spawn()
+        hoshino.logger.info(
+            f"表情制作进程池已启动，共 {self.workers} 个进程，耗时 {(time.perf_counter() - start) * 1000:.1f}ms"
+        )
+
+    async def shutdown(self):
+        for task in list(self.__starting):
+            task.cancel()
+        tasks = [worker.kill() for worker in self.__all]
+        self.__all.clear()
+        await asyncio.gather(*tasks, *self.__reaping)
+
+    async def render(self, key: str, images: List[bytes], texts: List[str], args: Dict[str, Any]) -> bytes:
+        if self.__idle is None:
+            await self.start()
+        worker = await self.__idle.get()
+        budget = self.budget(key)
+        try:
+            ok, result = await asyncio.wait_for(worker.call((key, images, texts, args)), budget or None)
+        except asyncio.TimeoutError:
+            self.__replace(worker)
+            raise self._timed_out(key, budget) from None
+        except (EOFError, OSError):
+            self.__replace(worker)
+            hoshino.logger.error(f"表情 {key} 制作时子进程意外退出，已重新创建")
+            raise RenderError("制作进程意外退出") from None
+        except BaseException:
+            # 被取消时子进程可能还在制作，结果无法再对应到请求上
+            self.__replace(worker)
+            raise
+        self.__idle.put_nowait(worker)
+        if not ok:
+            raise result
+        return result
+
+
+def create_engine(
+    name: str, workers: int = 0, timeout: float = 0, timeouts: Optional[Dict[str, float]] = None
+) -> RenderEngine:
+    if name == "process":
+        if "fork" in multiprocessing.get_all_start_methods():
+            return ProcessRenderEngine(workers, timeout, timeouts)
+        hoshino.logger.warning("当前平台不支持 fork，表情制作改为使用线程池")
+    elif name != "thread":
+        hoshino.logger.warning(f"未知的表情制作方式 {name}，改为使用线程池")
+    return RenderEngine(timeout, timeouts)
+
+
+class RenderQueue:
+    """制作任务的准入控制：限制全局和每个群同时制作的数量
+
+    排队的任务超过 `maxsize` 时立即拒绝，排队超过 `timeout` 秒也会放弃，
+    均抛出 `RenderBusyError`，宁可丢弃请求也不在很久之后才回复。
+    """
+
+    def __init__(self, concurrency: int = 4, group_concurrency: int = 0, maxsize: int = 0, timeout: float = 0):
+        self.concurrency = concurrency
+        self.group_concurrency = group_concurrency
+        self.maxsize = maxsize
+        self.timeout = timeout
+        self.__global = asyncio.Semaphore(concurrency) if concurrency else None
+        # 群号 -> [信号量, 正在使用的任务数]，没有任务时删除
+        self.__groups: Dict[Any, List[Any]] = {}
+        self.__waits: Deque[float] = deque(maxlen=200)
+        self.waiting = 0
+        self.running = 0
+        self.rejected = 0
+
+    def stats(self) -> Dict[str, float]:
+        waits = list(self.__waits)
+        return {
+            "running": self.running,
+            "waiting": self.waiting,
+            "rejected": self.rejected,
+            "avg_wait": sum(waits) / len(waits) if waits else 0,
+            "max_wait": max(waits, default=0),
+        }
+
+    async def __acquire(self, semaphores: List[asyncio.Semaphore], acquired: List[asyncio.Semaphore]):
+        for semaphore in semaphores:
+            await semaphore.acquire()
+            acquired.append(semaphore)
+
+    @asynccontextmanager
+    async def slot(self, group_id: Any = None) -> AsyncIterator[None]:
+        semaphores: List[asyncio.Semaphore] = []
+        group = None
+        if self.group_concurrency and group_id is not None:
+            group = self.__groups.setdefault(group_id, [asyncio.Semaphore(self.group_concurrency), 0])
+            group[1] += 1
+            semaphores.append(group[0])
+        # 先占群的名额再占全局名额，避免一个群排队的任务占住全局名额
+        if self.__global:
+            semaphores.append(self.__global)
+
+        acquired: List[asyncio.Semaphore] = []
+        try:
+            if not any(semaphore.locked() for semaphore in semaphores):
+                # 有空闲名额时不经过排队，这里的 acquire 不会挂起
+                await self.__acquire(semaphores, acquired)
+                self.__waits.append(0)
+            else:
+                await self.__wait(semaphores, acquired)
+        except BaseException:
+            self.__release(group_id, group, acquired)
+            raise
+
+        def done(*_: Any):
+            self.running -= 1
+            self.__release(group_id, group, acquired)
+
+        self.running += 1
+        pending: "Optional[asyncio.Future[Any]]" = None
+        try:
+            yield
+        except RenderTimeoutError as e:
+            pending = e.pending
+            raise
+        finally:
+            if pending is not None and not pending.done():
+                # 超时的制作还在线程中运行，结束后才释放名额，避免卡住的制作超出并发上限
+                pending.add_done_callback(done)
+            else:
+                done()
+
+    def __release(self, group_id: Any, group: Optional[List[Any]], acquired: List[asyncio.Semaphore]):
+        for semaphore in acquired:
+            semaphore.release()
+        if group is not None:
+            group[1] -= 1
+            if not group[1]:
+                self.__groups.pop(group_id, None)
+
+    async def __wait(self, semaphores: List[asyncio.Semaphore], acquired: List[asyncio.Semaphore]):
+        if self.maxsize and self.waiting >= self.maxsize:
+            self.rejected += 1
+            raise RenderBusyError(f"制作队列已满（{self.waiting} 个任务排队）")
+        start = time.monotonic()
+        self.waiting += 1
+        try:
+            await asyncio.wait_for(self.__acquire(semaphores, acquired), self.timeout or None)
+        except asyncio.TimeoutError:
+            self.rejected += 1
+            raise RenderBusyError(f"排队超过 {self.timeout:g} 秒") from None
+        finally:
+            self.waiting -= 1
+        self.__waits.append(time.monotonic() - start)
+
+
+render_engine = create_engine(
+    memes_render_engine, memes_render_workers, memes_render_timeout, memes_render_timeouts
+)
+render_queue = RenderQueue(
+    memes_render_concurrency,
+    memes_render_group_concurrency,
+    memes_render_queue_size,
+    memes_render_queue_timeout,
+)
+render_cache: LRUCache[str, bytes] = LRUCache(0, int(memes_render_cache_memory_size * 10 ** 6))
+# 相同的请求同时到来时只制作一次
+render_flight: SingleFlight[str, bytes] = SingleFlight()
+
+
+def render_key(key: str, images: List[bytes], texts: List[str], args: Dict[str, Any]) -> str:
+    md5 = hashlib.md5(key.encode("utf8"))
+    # 表情或 meme_generator 更新后结果可能变化
+    md5.update(repr((meme_generator_version, meme_registry.fingerprint(key))).encode("utf8"))
+    for image in images:
+        md5.update(hashlib.md5(image).digest())
+    # 输入图片的处理设置和输出大小上限会影响结果
+    md5.update(repr((normalize_options(key), memes_output_max_size)).encode("utf8"))
+    md5.update(json.dumps([texts, args], sort_keys=True, ensure_ascii=False, default=str).encode("utf8"))
+    return md5.hexdigest()
+
+
+async def clear_render_cache():
+    # 资源文件更新后制作结果可能变化
+    render_cache.clear()
+    await disk_cache.clear("render")
+
+
+async def render(
+    key: str, images: List[bytes], texts: List[str], args: Dict[str, Any], group_id: Any = None
+) -> bytes:
+    """制作表情，相同的表情、图片、文字和参数直接返回缓存的结果，正在制作的则等待其结果
+
+    只有真正需要制作时才进入 `render_queue` 排队。
+    结果带有随机性的表情（如 `mahoo`、`crawl`）应加入 `memes_render_cache_exclude`。
+    """
+    if key in memes_render_cache_exclude:
+        async with render_queue.slot(group_id):
+            return await render_engine.render(key, images, texts, args)
+    name = render_key(key, images, texts, args)
+    return await render_flight.do(name, lambda: _render_cached(name, key, images, texts, args, group_id))
+
+
+async def _render_cached(
+    name: str, key: str, images: List[bytes], texts: List[str], args: Dict[str, Any], group_id: Any
+) -> bytes:
+    use_memory = memes_render_cache_memory_size > 0
+    if use_memory and (result := render_cache.get(name)) is not None:
+        return result
+    if memes_render_cache_disk and (result := await disk_cache.get("render", name)) is not None:
+        if use_memory:
+            render_cache.set(name, result)
+        return result
+
+    async with render_queue.slot(group_id):
+        result = await render_engine.render(key, images, texts, args)
+    if use_memory:
+        render_cache.set(name, result)
+    if memes_render_cache_disk:
+        await disk_cache.set("render", name, result)
+    return result
+
+
+@on_startup
+async def _():
+    await render_engine.start()
+    get_bot().server_app.after_serving(render_engine.shutdown)
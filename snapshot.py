@@ -0,0 +1,61 @@
+import hashlib
+import os
+import pickle
+from pathlib import Path
+from typing import Any, Dict, Iterable, Optional, Tuple
+
+import hoshino
+
+SNAPSHOT_VERSION = 1
+
+snapshot_path = Path(os.path.join(os.path.dirname(__file__), "memes_cache_dir", "manager.pickle"))
+
+
+def file_fingerprint(*paths: Path) -> Tuple[Tuple[int, int], ...]:
+    result = []
+    for path in paths:
+        try:
+            stat = path.stat()
+        except OSError:
+            result.append((0, 0))
+            continue
+        result.append((stat.st_mtime_ns, stat.st_size))
+    return tuple(result)
+
+
+def memes_hash(memes: Iterable[Any]) -> str:
+    md5 = hashlib.md5()
+    for meme in memes:
+        md5.update(meme.key.encode("utf8"))
+        md5.update("\0".join(meme.keywords).encode("utf8"))
+        md5.update("\0".join(shortcut.key for shortcut in meme.shortcuts).encode("utf8"))
+        md5.update(b"\n")
+    return md5.hexdigest()
+
+
+def load_snapshot(key: Tuple[Any, ...], path: Path = snapshot_path) -> Optional[Dict[str, Any]]:
+    try:
+        with path.open("rb") as f:
+            snapshot = pickle.load(f)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        hoshino.logger.warning(f"表情快照读取失败: {e}")
+        return None
+    if not isinstance(snapshot, dict):
+        return None
+    if snapshot.get("version") != SNAPSHOT_VERSION or snapshot.get("key") != key:
+        return None
+    return snapshot["data"]
+
+
+def save_snapshot(key: Tuple[Any, ...], data: Dict[str, Any], path: Path = snapshot_path):
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    with tmp_path.open("wb") as f:
+        pickle.dump(
+            {"version": SNAPSHOT_VERSION, "key": key, "data": data},
+            f,
+            protocol=pickle.HIGHEST_PROTOCOL,
+        )
+    tmp_path.replace(path)
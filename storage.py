@@ -0,0 +1,331 @@
+import atexit
+import sqlite3
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+from typing import Any, Dict, List, Optional, Tuple
+
+from pydantic import BaseModel
+from yaml import CLoader, dump, load, safe_load, unsafe_load
+from yaml.constructor import ConstructorError
+
+import hoshino
+from .data_source.compat import PYDANTIC_V2
+from .permission import MemeMode, Principal
+from .snapshot import file_fingerprint
+
+Rule = Tuple[Principal, str, Optional[bool]]
+
+
+class MemeConfig(BaseModel):
+    mode: int = MemeMode.BLACK.value
+    white_list: List[str] = []
+    black_list: List[str] = []
+
+    class Config:
+        use_enum_values = True
+
+
+def load_yaml(path: Path) -> Tuple[Dict[str, int], List[Rule]]:
+    raw_list: Dict[str, Any] = {}
+    if path.exists():
+        try:
+            with path.open("r", encoding="utf-8") as f:
+                content = f.read()
+                try:
+                    raw_list = safe_load(content)
+                except ConstructorError as e:
+                    hoshino.logger.warning(f"无法使用 safe_load: {e}")
+                    try:
+                        hoshino.logger.warning("尝试使用 CLoader")
+                        raw_list = load(content, Loader=CLoader)
+                    except ConstructorError as e:
+                        hoshino.logger.warning(f"无法使用 CLoader: {e}")
+                        raw_list = unsafe_load(content)
+        except UnicodeDecodeError:
+            hoshino.logger.warning("表情列表解析失败（编码错误），将重新生成")
+        except Exception as e:
+            hoshino.logger.warning(f"表情列表读取失败: {e}，将重新生成")
+
+    try:
+        meme_list = {
+            name: MemeConfig.model_validate(config) if PYDANTIC_V2 else MemeConfig.parse_obj(config)
+            for name, config in raw_list.items()
+        }
+    except AttributeError:
+        meme_list = {}
+        hoshino.logger.warning("表情列表解析失败，将重新生成")
+
+    modes: Dict[str, int] = {}
+    rules: List[Rule] = []
+    for key, config in meme_list.items():
+        modes[key] = int(config.mode)
+        for uid in config.white_list:
+            if principal := Principal.parse(uid):
+                rules.append((principal, key, True))
+        for uid in config.black_list:
+            if principal := Principal.parse(uid):
+                rules.append((principal, key, False))
+    return modes, rules
+
+
+def dump_yaml(path: Path, modes: Dict[str, int], rules: List[Rule]):
+    configs = {key: MemeConfig(mode=mode) for key, mode in modes.items()}
+    for principal, key, enabled in rules:
+        if enabled is None:
+            continue
+        config = configs.setdefault(key, MemeConfig())
+        (config.white_list if enabled else config.black_list).append(str(principal))
+
+    meme_list = {}
+    for name, config in configs.items():
+        if PYDANTIC_V2:
+            config_dict = config.model_dump()
+        else:
+            config_dict = config.dict()
+
+        if isinstance(config_dict["mode"], MemeMode):
+            config_dict["mode"] = config_dict["mode"].value
+
+        meme_list[name] = config_dict
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.tmp")
+    with tmp_path.open("w", encoding="utf-8") as f:
+        dump(meme_list, f, allow_unicode=True)
+    tmp_path.replace(path)
+
+
+class PermissionStore:
+    """表情开关的持久化后端
+
+    改动先进入内存队列，在 `delay` 秒后由后台线程合并成一次提交，
+    不在事件循环上做任何文件读写。
+    """
+
+    def __init__(self, delay: float = 1.0):
+        self._delay = delay
+        self._lock = threading.Lock()
+        self._commit_lock = threading.Lock()
+        self._pending: List[Tuple[str, Any]] = []
+        self._timer: Optional[threading.Timer] = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="meme_store")
+        atexit.register(self.flush)
+
+    def load(self) -> Tuple[Dict[str, int], List[Rule]]:
+        raise NotImplementedError
+
+    def seed(self, modes: Dict[str, int], rules: List[Rule]):
+        # 使用启动快照时不调用 load，由快照提供当前的表情开关
+        pass
+
+    def fingerprint(self) -> Tuple[Any, ...]:
+        # 用于判断启动快照是否仍然有效
+        return ()
+
+    def prepare(self):
+        # 启动完成后在后台线程调用，做建表、迁移等需要写盘的准备工作
+        pass
+
+    def set_mode(self, key: str, mode: int):
+        self._submit(("mode", (key, int(mode))))
+
+    def set_rule(self, principal: Principal, key: str, enabled: Optional[bool]):
+        self._submit(("rule", (principal, key, enabled)))
+
+    def _submit(self, op: Tuple[str, Any]):
+        with self._lock:
+            self._pending.append(op)
+            if self._timer is None:
+                self._timer = threading.Timer(
+                    self._delay, self._executor.submit, args=(self.flush,)
+                )
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._commit_lock:
+            with self._lock:
+                ops, self._pending = self._pending, []
+                if self._timer is not None:
+                    self._timer.cancel()
+                    self._timer = None
+            if not ops:
+                return
+            try:
+                self._commit(ops)
+            except Exception as e:
+                hoshino.logger.error(f"表情开关保存失败: {e}")
+
+    def _commit(self, ops: List[Tuple[str, Any]]):
+        raise NotImplementedError
+
+
+class YamlPermissionStore(PermissionStore):
+    def __init__(self, path: Path, delay: float = 1.0):
+        super().__init__(delay)
+        self.path = path
+        self.__modes: Dict[str, int] = {}
+        self.__rules: Dict[Tuple[Principal, str], bool] = {}
+
+    def load(self) -> Tuple[Dict[str, int], List[Rule]]:
+        modes, rules = load_yaml(self.path)
+        self.seed(modes, rules)
+        return modes, rules
+
+    def seed(self, modes: Dict[str, int], rules: List[Rule]):
+        # 每次提交都会重写整个文件，必须先有完整的表情开关
+        self.__modes = dict(modes)
+        self.__rules = {(principal, key): enabled for principal, key, enabled in rules}
+
+    def fingerprint(self) -> Tuple[Any, ...]:
+        return file_fingerprint(self.path)
+
+    def _commit(self, ops: List[Tuple[str, Any]]):
+        for kind, value in ops:
+            if kind == "mode":
+                key, mode = value
+                self.__modes[key] = mode
+            else:
+                principal, key, enabled = value
+                if enabled is None:
+                    self.__rules.pop((principal, key), None)
+                else:
+                    self.__rules[(principal, key)] = enabled
+        dump_yaml(
+            self.path,
+            self.__modes,
+            [(principal, key, enabled) for (principal, key), enabled in self.__rules.items()],
+        )
+
+
+class SqlitePermissionStore(PermissionStore):
+    def __init__(
+        self,
+        path: Path,
+        yaml_path: Optional[Path] = None,
+        yaml_export: bool = False,
+        delay: float = 1.0,
+    ):
+        super().__init__(delay)
+        self.path = path
+        self.yaml_path = yaml_path
+        self.yaml_export = yaml_export
+        self.__conn: Optional[sqlite3.Connection] = None
+
+    def __connect(self) -> sqlite3.Connection:
+        if self.__conn is not None:
+            return self.__conn
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        with conn:
+            conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS meme_mode (
+                    meme_key TEXT PRIMARY KEY,
+                    mode INTEGER NOT NULL
+                );
+                CREATE TABLE IF NOT EXISTS meme_rule (
+                    bot_id TEXT NOT NULL,
+                    group_id TEXT NOT NULL,
+                    user_id TEXT NOT NULL DEFAULT '',
+                    meme_key TEXT NOT NULL,
+                    enabled INTEGER NOT NULL,
+                    PRIMARY KEY (bot_id, group_id, user_id, meme_key)
+                );
+                CREATE INDEX IF NOT EXISTS meme_rule_key ON meme_rule (meme_key);
+                CREATE TABLE IF NOT EXISTS meta (
+                    name TEXT PRIMARY KEY,
+                    value TEXT NOT NULL
+                );
+                """
+            )
+        self.__conn = conn
+        self.__import_yaml()
+        return conn
+
+    def load(self) -> Tuple[Dict[str, int], List[Rule]]:
+        with self._commit_lock:
+            if not self.path.exists():
+                # 数据库还不存在时直接读取 config.yml，建库和导入留到启动完成后
+                return load_yaml(self.yaml_path) if self.yaml_path else ({}, [])
+            self.__connect()
+            return self.__read()
+
+    def fingerprint(self) -> Tuple[Any, ...]:
+        paths = [self.path, self.path.with_name(f"{self.path.name}-wal")]
+        if self.yaml_path:
+            paths.append(self.yaml_path)
+        return file_fingerprint(*paths)
+
+    def prepare(self):
+        with self._commit_lock:
+            self.__connect()
+
+    def __read(self) -> Tuple[Dict[str, int], List[Rule]]:
+        modes = {
+            key: mode
+            for key, mode in self.__conn.execute("SELECT meme_key, mode FROM meme_mode")
+        }
+        rules: List[Rule] = [
+            (Principal(bot_id, group_id, user_id or None), key, bool(enabled))
+            for bot_id, group_id, user_id, key, enabled in self.__conn.execute(
+                "SELECT bot_id, group_id, user_id, meme_key, enabled FROM meme_rule"
+            )
+        ]
+        return modes, rules
+
+    def __import_yaml(self):
+        # 首次启用 sqlite 时，从旧的 config.yml 导入一次
+        if self.__conn.execute("SELECT 1 FROM meta WHERE name = 'yaml_imported'").fetchone():
+            return
+        modes: Dict[str, int] = {}
+        rules: List[Rule] = []
+        if self.yaml_path and self.yaml_path.exists():
+            modes, rules = load_yaml(self.yaml_path)
+            hoshino.logger.info(f"从 {self.yaml_path.name} 导入了 {len(rules)} 条表情开关记录")
+        with self.__conn:
+            self.__write(
+                [("mode", item) for item in modes.items()]
+                + [("rule", rule) for rule in rules]
+            )
+            self.__conn.execute(
+                "INSERT OR REPLACE INTO meta (name, value) VALUES ('yaml_imported', '1')"
+            )
+
+    def __write(self, ops: List[Tuple[str, Any]]):
+        # 同一条记录只保留最后一次改动
+        modes: Dict[str, int] = {}
+        rules: Dict[Tuple[str, str, str, str], Optional[bool]] = {}
+        for kind, value in ops:
+            if kind == "mode":
+                key, mode = value
+                modes[key] = mode
+            else:
+                principal, key, enabled = value
+                rules[(principal.bot_id, principal.group_id, principal.user_id or "", key)] = enabled
+        self.__conn.executemany(
+            "INSERT OR REPLACE INTO meme_mode (meme_key, mode) VALUES (?, ?)", modes.items()
+        )
+        self.__conn.executemany(
+            "DELETE FROM meme_rule WHERE bot_id = ? AND group_id = ? AND user_id = ? AND meme_key = ?",
+            [row for row, enabled in rules.items() if enabled is None],
+        )
+        self.__conn.executemany(
+            "INSERT OR REPLACE INTO meme_rule (bot_id, group_id, user_id, meme_key, enabled) "
+            "VALUES (?, ?, ?, ?, ?)",
+            [row + (int(enabled),) for row, enabled in rules.items() if enabled is not None],
+        )
+
+    def _commit(self, ops: List[Tuple[str, Any]]):
+        with self.__connect():
+            self.__write(ops)
+        if self.yaml_export and self.yaml_path:
+            dump_yaml(self.yaml_path, *self.__read())
+
+    def export_yaml(self, path: Path):
+        with self._commit_lock:
+            self.__connect()
+            dump_yaml(path, *self.__read())
@@ -0,0 +1,43 @@
+import asyncio
+import functools
+import logging
+import sys
+import types
+from pathlib import Path
+
+import nonebot
+
+ROOT = Path(__file__).resolve().parents[1]
+
+# 部分模块导入时就会通过 get_bot() 注册关闭时的回调
+try:
+    nonebot.get_bot()
+except ValueError:
+    nonebot.init()
+
+# 插件依赖 HoshinoBot 本体，测试中只提供插件用到的部分，与 HoshinoBot 中的定义一致
+try:
+    import hoshino  # noqa: F401
+except ImportError:
+    from aiocqhttp import Event, Message, MessageSegment
+
+    async def run_sync_func(func, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(None, functools.partial(func, *args, **kwargs))
+
+    hoshino = types.ModuleType("hoshino")
+    hoshino.logger = logging.getLogger("hoshino")
+    hoshino.HoshinoBot = nonebot.NoneBot
+    aiorequests = types.ModuleType("hoshino.aiorequests")
+    aiorequests.run_sync_func = run_sync_func
+    typing = types.ModuleType("hoshino.typing")
+    typing.CQEvent = Event
+    typing.Message = Message
+    typing.MessageSegment = MessageSegment
+    hoshino.aiorequests = aiorequests
+    hoshino.typing = typing
+    sys.modules.update({"hoshino": hoshino, "hoshino.aiorequests": aiorequests, "hoshino.typing": typing})
+
+# 以包的形式导入插件中的模块，但不执行会注册服务的 __init__.py
+plugin = types.ModuleType("memes_plugin")
+plugin.__path__ = [str(ROOT)]
+sys.modules.setdefault("memes_plugin", plugin)
@@ -0,0 +1,46 @@
+import asyncio
+import functools
+
+from memes_plugin import manager, snapshot
+from memes_plugin.manager import MemeManager
+from memes_plugin.permission import MemeMode, Principal
+from memes_plugin.storage import YamlPermissionStore, dump_yaml, load_yaml
+
+GROUP = Principal("1", "100")
+
+
+def create_manager(path) -> MemeManager:
+    return MemeManager(path, YamlPermissionStore(path))
+
+
+def test_yaml_rules_kept_after_snapshot_hit(tmp_path, monkeypatch):
+    snapshot_path = tmp_path / "manager.pickle"
+    monkeypatch.setattr(manager, "load_snapshot", functools.partial(snapshot.load_snapshot, path=snapshot_path))
+    monkeypatch.setattr(manager, "save_snapshot", functools.partial(snapshot.save_snapshot, path=snapshot_path))
+    path = tmp_path / "config.yml"
+    dump_yaml(
+        path,
+        {"kiss": MemeMode.WHITE},
+        [(GROUP, "kiss", True), (Principal("1", "100", "998"), "petpet", False)],
+    )
+    asyncio.run(create_manager(path).prepare())
+
+    warm = create_manager(path)
+    assert warm._MemeManager__snapshot_hit
+    warm.block(Principal("1", "100", "999"), ["petpet"])
+    warm._MemeManager__store.flush()
+
+    modes, rules = load_yaml(path)
+    assert modes["kiss"] == MemeMode.WHITE
+    assert set(rules) == {
+        (GROUP, "kiss", True),
+        (Principal("1", "100", "998"), "petpet", False),
+        (Principal("1", "100", "999"), "petpet", False),
+    }
+
+    reloaded = create_manager(path)
+    assert not reloaded._MemeManager__snapshot_hit
+    assert reloaded.check(Principal("1", "100", "997"), "kiss")
+    assert not reloaded.check(Principal("1", "200", "997"), "kiss")
+    assert not reloaded.check(Principal("1", "100", "999"), "petpet")
+    assert reloaded.check(Principal("1", "100", "997"), "petpet")
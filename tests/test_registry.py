@@ -0,0 +1,61 @@
+import uuid
+
+import pytest
+from meme_generator.manager import get_meme_keys
+
+from memes_plugin import registry
+from memes_plugin.registry import MemeRegistry
+
+MEME_MODULE = """
+from meme_generator import add_meme
+
+
+def {key}(images, texts, args):
+    raise NotImplementedError
+
+
+add_meme("{key}", {key}, min_texts=1, max_texts=1, keywords=["{key}_keyword"])
+"""
+
+
+@pytest.fixture
+def meme_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(registry, "registry_path", tmp_path / "registry.pickle")
+    memes_dir = tmp_path / "memes"
+    memes_dir.mkdir()
+    return memes_dir
+
+
+def add_module(meme_dir) -> str:
+    # meme_generator 的表情是全局注册的，每个测试使用不同的 key
+    key = f"test_{uuid.uuid4().hex[:8]}"
+    (meme_dir / f"{key}.py").write_text(MEME_MODULE.format(key=key), encoding="utf8")
+    return key
+
+
+def keys(memes):
+    return [meme.key for meme in memes]
+
+
+def test_eager_load(meme_dir):
+    key = add_module(meme_dir)
+    memes = MemeRegistry([str(meme_dir)], lazy=False).memes()
+    assert key in get_meme_keys()
+    assert keys(memes).count(key) == 1
+
+
+def test_cache_miss(meme_dir):
+    key = add_module(meme_dir)
+    memes = MemeRegistry([str(meme_dir)], lazy=True).memes()
+    assert keys(memes).count(key) == 1
+    assert next(meme for meme in memes if meme.key == key).keywords == [f"{key}_keyword"]
+
+
+def test_cache_hit(meme_dir):
+    key = add_module(meme_dir)
+    MemeRegistry([str(meme_dir)], lazy=True).save()
+    # 未修改的模块直接使用缓存的元数据，只返回占位对象
+    lazy = MemeRegistry([str(meme_dir)], lazy=True)
+    memes = lazy.memes()
+    assert keys(memes).count(key) == 1
+    assert lazy.load(key).key == key
@@ -0,0 +1,39 @@
+import asyncio
+import threading
+
+import pytest
+
+from memes_plugin import render
+from memes_plugin.exception import RenderTimeoutError
+from memes_plugin.render import RenderEngine, RenderQueue
+
+
+def test_timed_out_thread_keeps_slot(monkeypatch):
+    release = threading.Event()
+
+    def render_meme(key, images, texts, args):
+        release.wait(5)
+        return b""
+
+    monkeypatch.setattr(render, "render_meme", render_meme)
+    engine = RenderEngine(timeout=0.05)
+    queue = RenderQueue(concurrency=1)
+
+    async def main():
+        with pytest.raises(RenderTimeoutError):
+            async with queue.slot(1):
+                await engine.render("stuck", [], [], {})
+        # 线程还在制作，名额不能交给下一个任务
+        assert queue.running == 1
+        slot = queue.slot(1)
+        waiter = asyncio.ensure_future(slot.__aenter__())
+        await asyncio.sleep(0.05)
+        assert not waiter.done()
+
+        release.set()
+        await asyncio.wait_for(waiter, 1)
+        assert queue.running == 1
+        await slot.__aexit__(None, None, None)
+        assert queue.running == 0
+
+    asyncio.run(main())
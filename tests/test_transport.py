@@ -0,0 +1,25 @@
+import asyncio
+
+from memes_plugin.cache import LRUCache
+from memes_plugin.transport import Transport
+
+
+def test_evicted_pin_is_swept(tmp_path):
+    transport = Transport("file", tmp_path, ttl=0.05)
+    cache = LRUCache(1, on_evict=lambda _, payload: transport.unpin(payload))
+
+    async def main():
+        first = await transport.encode(b"first", pin=True)
+        cache.set("first", first)
+        await asyncio.sleep(0.1)
+        # 仍在缓存中的图片不会被清理
+        cache.set("second", await transport.encode(b"second", pin=True))
+        assert len(list(tmp_path.iterdir())) == 2
+
+        await asyncio.sleep(0.1)
+        await transport.encode(b"third")
+        names = sorted(path.name for path in tmp_path.iterdir())
+        assert first.rsplit("/", 1)[-1] not in names
+        assert len(names) == 2
+
+    asyncio.run(main())
@@ -0,0 +1,51 @@
+import asyncio
+from types import SimpleNamespace
+
+from memes_plugin.cache import LRUCache
+from memes_plugin.data_source import user_info
+
+
+class FakeBot:
+    """两个各有 80 名成员的群，记录调用了哪些接口"""
+
+    def __init__(self):
+        self.calls = []
+
+    async def get_group_member_list(self, group_id):
+        self.calls.append(("list", group_id))
+        return [self.member(group_id, group_id * 10000 + i) for i in range(1000, 1080)]
+
+    async def get_group_member_info(self, group_id, user_id):
+        self.calls.append(("member", user_id))
+        return self.member(group_id, user_id)
+
+    async def get_stranger_info(self, user_id):
+        self.calls.append(("stranger", user_id))
+        return {"user_id": user_id, "nickname": f"stranger{user_id}"}
+
+    @staticmethod
+    def member(group_id, user_id):
+        return {"user_id": user_id, "nickname": f"user{user_id}", "card": f"card{group_id}_{user_id}"}
+
+
+def test_evicted_member_keeps_group_card(monkeypatch):
+    monkeypatch.setattr(user_info, "memes_user_info_bulk_load", True)
+    monkeypatch.setattr(user_info, "user_info_cache", LRUCache(100))
+    monkeypatch.setattr(user_info, "_group_members", {})
+    bot = FakeBot()
+
+    async def main():
+        first = await user_info.get_user_info(bot, SimpleNamespace(group_id=1), 11005)
+        # 加载第二个群会把第一个群的大部分成员挤出缓存
+        await user_info.get_user_info(bot, SimpleNamespace(group_id=2), 21005)
+        evicted = await user_info.get_user_info(bot, SimpleNamespace(group_id=1), 11010)
+        stranger = await user_info.get_user_info(bot, SimpleNamespace(group_id=1), 99999)
+        return first, evicted, stranger
+
+    first, evicted, stranger = asyncio.run(main())
+    assert first.user_displayname == "card1_11005"
+    assert evicted.user_displayname == "card1_11010"
+    assert ("member", 11010) in bot.calls
+    assert stranger.user_displayname is None
+    assert ("stranger", 99999) in bot.calls
+    assert bot.calls.count(("list", 1)) == 1
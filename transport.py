@@ -0,0 +1,132 @@
+import base64
+import hashlib
+import os
+import re
+import time
+import uuid
+from collections import Counter
+from io import BytesIO
+from pathlib import Path
+from typing import Union
+
+from nonebot import get_bot
+
+import hoshino
+from hoshino.aiorequests import run_sync_func
+from .cache import memes_cache_dir
+from .config import memes_send_dir, memes_send_mode, memes_send_ttl, memes_send_url
+
+NAME_PATTERN = re.compile(r"[0-9a-f]{32}\.(gif|png|jpg)")
+MIME_TYPES = {"gif": "image/gif", "png": "image/png", "jpg": "image/jpeg"}
+
+
+def image_ext(data: bytes) -> str:
+    if data.startswith(b"GIF8"):
+        return "gif"
+    if data.startswith(b"\x89PNG"):
+        return "png"
+    return "jpg"
+
+
+class Transport:
+    """把图片交给 OneBot 实现的方式
+
+    - `base64`：编码后放在消息里，不需要额外配置
+    - `file`：写入 `dir` 后发送 `file://` 路径，需要 OneBot 实现能读取该目录
+    - `http`：写入 `dir` 后由 bot 自身的 web 服务提供，发送 `url` 下的链接
+
+    文件以内容的 md5 命名，超过 `ttl` 秒未再发送的会被清理；表情列表、预览图等
+    结果被缓存的图片需要固定（`pin`），保证缓存的链接一直有效，缓存淘汰时再 `unpin`。
+    写入失败时退回 base64。
+    """
+
+    def __init__(self, mode: str = "base64", dir: Union[str, Path] = "", url: str = "", ttl: float = 600):
+        if mode not in ("base64", "file", "http"):
+            hoshino.logger.warning(f"未知的表情发送方式 {mode}，使用 base64")
+            mode = "base64"
+        if mode == "http" and not url:
+            hoshino.logger.warning("使用 http 发送表情需要设置 memes_send_url，使用 base64")
+            mode = "base64"
+        self.mode = mode
+        self.dir = Path(dir or memes_cache_dir / "_send").resolve()
+        self.url = url.rstrip("/")
+        self.ttl = ttl
+        # 文件名 -> 引用它的缓存条目数
+        self.__pinned: Counter = Counter()
+        self.__last_sweep = time.monotonic()
+
+    @staticmethod
+    def base64(data: bytes) -> str:
+        return f"base64://{base64.b64encode(data).decode()}"
+
+    def __write(self, name: str, data: bytes):
+        path = self.dir / name
+        if path.exists():
+            # 相同的图片已经写过，刷新修改时间以免被清理
+            os.utime(path)
+            return
+        self.dir.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.dir / f".{name}.{uuid.uuid4().hex}.tmp"
+        tmp_path.write_bytes(data)
+        os.replace(tmp_path, path)
+
+    def __sweep(self):
+        if not self.dir.is_dir():
+            return
+        deadline = time.time() - self.ttl
+        for file in os.scandir(self.dir):
+            if not file.is_file() or file.name in self.__pinned:
+                continue
+            try:
+                if file.stat().st_mtime < deadline:
+                    os.remove(file.path)
+            except OSError:
+                pass
+
+    async def encode(self, img: Union[BytesIO, bytes], pin: bool = False) -> str:
+        """返回可以放进 `MessageSegment.image` 的图片"""
+        data = img.getvalue() if isinstance(img, BytesIO) else img
+        if self.mode == "base64":
+            return self.base64(data)
+
+        name = f"{hashlib.md5(data).hexdigest()}.{image_ext(data)}"
+        try:
+            await run_sync_func(self.__write, name, data)
+        except OSError as e:
+            hoshino.logger.warning(f"写入待发送的表情 {name} 失败，使用 base64 发送: {e}")
+            return self.base64(data)
+        if pin:
+            self.__pinned[name] += 1
+        if self.ttl and time.monotonic() - self.__last_sweep > self.ttl / 2:
+            self.__last_sweep = time.monotonic()
+            await run_sync_func(self.__sweep)
+
+        if self.mode == "file":
+            return (self.dir / name).as_uri()
+        return f"{self.url}/memes/{name}"
+
+    def unpin(self, payload: str):
+        """缓存不再保存 `encode(pin=True)` 的结果时调用，之后的文件按 `ttl` 清理"""
+        if payload.startswith("base64://"):
+            return
+        name = payload.rsplit("/", 1)[-1]
+        self.__pinned[name] -= 1
+        if self.__pinned[name] <= 0:
+            del self.__pinned[name]
+
+    async def serve(self, name: str):
+        from quart import Response, abort
+
+        if not NAME_PATTERN.fullmatch(name):
+            abort(404)
+        try:
+            data = await run_sync_func((self.dir / name).read_bytes)
+        except OSError:
+            abort(404)
+        return Response(data, mimetype=MIME_TYPES[name.rsplit(".", 1)[1]])
+
+
+transport = Transport(memes_send_mode, memes_send_dir, memes_send_url, memes_send_ttl)
+
+if transport.mode == "http":
+    get_bot().server_app.add_url_rule("/memes/<name>", "memes_send", transport.serve)
@@ -1,36 +1,59 @@
 import asyncio
-import base64
+import hashlib
 import shlex
-from io import BytesIO
-from typing import Union
+import time
+from itertools import chain
+from typing import Any, Dict, Tuple
 
-import httpx
 from arclet.alconna import TextFormatter
 from meme_generator.meme import Meme
+from meme_generator.utils import render_meme_list, MemeProperties
+from meme_generator.version import __version__ as meme_generator_version
+from nonebot import on_startup
+from pypinyin import Style, pinyin
 
 import hoshino
-from hoshino.typing import MessageSegment
+from hoshino import HoshinoBot
+from hoshino.aiorequests import run_sync_func
+from hoshino.typing import CQEvent, MessageSegment
+from .cache import LRUCache, SingleFlight, disk_cache
+from .data_source import get_content
 from .config import *
-from .exception import NetworkError
+from .manager import meme_manager
+from .permission import Principal
+from .registry import meme_registry
+from .transport import transport
+
+# 表情列表的拼音排序和内容哈希只在表情列表变化时重新计算
+_help_order: Tuple[int, List[int], str] = (-1, [], "")
+help_list_cache: LRUCache[Tuple[str, int], str] = LRUCache(
+    memes_help_cache_size, on_evict=lambda _, payload: transport.unpin(payload)
+)
+# 表情详情文字按表情列表版本缓存，预览图按表情和资源版本缓存
+_info_texts: Tuple[int, Dict[str, str]] = (-1, {})
+preview_cache: LRUCache[str, str] = LRUCache(
+    memes_preview_cache_size, on_evict=lambda _, payload: transport.unpin(payload)
+)
+# (bot, 消息 id) -> (get_msg 的结果, 过期时间)
+message_cache: LRUCache[Tuple[Any, int], Tuple[Dict[str, Any], float]] = LRUCache(
+    memes_message_cache_size
+)
+message_flight: SingleFlight[Tuple[Any, int], Dict[str, Any]] = SingleFlight()
 
 
-def bytesio2b64(img: Union[BytesIO, bytes]) -> str:
-    if isinstance(img, BytesIO):
-        img = img.getvalue()
-    return f"base64://{base64.b64encode(img).decode()}"
+async def download_url(url: str) -> bytes:
+    return await get_content(url)
 
 
-async def download_url(url: str) -> bytes:
-    async with httpx.AsyncClient() as client:
-        for i in range(3):
-            try:
-                resp = await client.get(url, timeout=20)
-                resp.raise_for_status()
-                return resp.content
-            except Exception as e:
-                hoshino.logger.warning(f"Error downloading {url}, retry {i}/3: {e}")
-                await asyncio.sleep(3)
-    raise NetworkError(f"{url} 下载失败！")
+async def get_msg(bot: HoshinoBot, ev: CQEvent, message_id: int) -> Dict[str, Any]:
+    """带短期缓存的 `bot.get_msg`，同一条消息的并发查询只调用一次"""
+    key = (ev.self_id, message_id)
+    cached = message_cache.get(key)
+    if cached and cached[1] > time.time():
+        return cached[0]
+    message = await message_flight.do(key, lambda: bot.get_msg(message_id=message_id))
+    message_cache.set(key, (message, time.time() + memes_message_cache_ttl))
+    return message
 
 
 def split_text(text: str) -> List[str]:
@@ -41,7 +64,66 @@ def split_text(text: str) -> List[str]:
         return text.split()
 
 
-async def meme_info(meme: Meme) -> str:
+def help_order() -> Tuple[List[int], str]:
+    global _help_order
+    version, order, list_hash = _help_order
+    if version == meme_manager.version:
+        return order, list_hash
+
+    memes = meme_manager.memes
+    order = sorted(
+        range(len(memes)),
+        key=lambda i: "".join(
+            chain.from_iterable(pinyin(memes[i].keywords[0], style=Style.TONE3))
+        ),
+    )
+    meme_list_hashable = [
+        {
+            "key": memes[i].key,
+            "keywords": memes[i].keywords,
+            "shortcuts": [
+                shortcut.humanized or shortcut.key for shortcut in memes[i].shortcuts
+            ],
+            "tags": sorted(memes[i].tags),
+        }
+        for i in order
+    ]
+    list_hash = hashlib.md5(str(meme_list_hashable).encode("utf8")).hexdigest()
+    _help_order = (meme_manager.version, order, list_hash)
+    return order, list_hash
+
+
+async def help_list(principal: Principal) -> str:
+    order, list_hash = help_order()
+    # 可用表情位图直接作为禁用状态的指纹
+    enabled = meme_manager.enabled(principal)
+    if payload := help_list_cache.get((list_hash, enabled)):
+        return payload
+
+    memes = meme_manager.memes
+    meme_list_hash = hashlib.md5(f"{list_hash}_{enabled:x}".encode("utf8")).hexdigest()
+    img = await disk_cache.get("help", f"{meme_list_hash}.jpg")
+    if img is None:
+        meme_list = [
+            (memes[i], MemeProperties(disabled=not enabled >> i & 1)) for i in order
+        ]
+        img = (await run_sync_func(render_meme_list, meme_list)).getvalue()
+        await disk_cache.set("help", f"{meme_list_hash}.jpg", img)
+
+    payload = await transport.encode(img, pin=True)
+    help_list_cache.set((list_hash, enabled), payload)
+    return payload
+
+
+def meme_info_text(meme: Meme) -> str:
+    global _info_texts
+    version, texts = _info_texts
+    if version != meme_manager.version:
+        texts = {}
+        _info_texts = (meme_manager.version, texts)
+    if info := texts.get(meme.key):
+        return info
+
     keywords = "、".join([f'"{keyword}"' for keyword in meme.keywords])
     shortcuts = "、".join(
         [f'"{shortcut.humanized or shortcut.key}"' for shortcut in meme.shortcuts]
@@ -84,13 +166,68 @@ async def meme_info(meme: Meme) -> str:
             + (f"\n可选参数：{args_info}" if args_info else "")
     )
     info += "\n表情预览：\n"
-    img = MessageSegment.image(bytesio2b64(meme.generate_preview()))
+    texts[meme.key] = info
+    return info
+
+
+def preview_name(meme: Meme) -> str:
+    # 插件目录中的表情带上模块文件的指纹，修改表情后预览随之更新
+    version = f"{meme.key}_{meme_generator_version}_{meme_registry.fingerprint(meme.key)}"
+    return hashlib.md5(version.encode("utf8")).hexdigest()
+
+
+async def preview_image(meme: Meme, name: str) -> bytes:
+    img = await disk_cache.get("preview", name)
+    if img is None:
+        img = (await run_sync_func(meme.generate_preview)).getvalue()
+        await disk_cache.set("preview", name, img)
+    return img
+
+
+async def meme_preview(meme: Meme) -> str:
+    name = preview_name(meme)
+    if payload := preview_cache.get(name):
+        return payload
+    payload = await transport.encode(await preview_image(meme, name), pin=True)
+    preview_cache.set(name, payload)
+    return payload
+
+
+async def clear_previews():
+    # 资源文件更新后预览图可能变化
+    preview_cache.clear()
+    await disk_cache.clear("preview")
+
+
+async def meme_info(meme: Meme) -> str:
+    info = meme_info_text(meme)
+    img = MessageSegment.image(await meme_preview(meme))
     return f"{info}{img}"
 
 
+async def generate_previews():
+    start = time.perf_counter()
+    count = 0
+    for meme in list(meme_manager.memes):
+        try:
+            await preview_image(meme, preview_name(meme))
+            count += 1
+        except Exception as e:
+            hoshino.logger.warning(f"表情 {meme.key} 预览生成失败: {e}")
+    hoshino.logger.info(
+        f"预先生成了 {count} 个表情预览，耗时 {time.perf_counter() - start:.1f}s"
+    )
+
+
+@on_startup
+async def _():
+    await disk_cache.scan()
+    if memes_preview_on_startup:
+        asyncio.create_task(generate_previews())
+
+
 if memes_check_resources_on_startup:
     from meme_generator.download import check_resources
-    from nonebot import on_startup
 
 
     @on_startup